@@ -0,0 +1,477 @@
+"""Бенчмарки бота.
+
+Запуск:
+    python benchmark.py parse [страница.html ...]
+    python benchmark.py tick [--users 1000 10000 100000] [--save base.json | --compare base.json]
+    python benchmark.py webhook http://127.0.0.1:8443/telegram --secret SECRET [--count 1000]
+    python benchmark.py calc [--city saratov] [--db namaz_bot.db]
+
+parse - сравнивает бэкенды разбора HTML расписания на обычной и рамаданской
+таблицах (синтетических или сохраненных страницах dumso.ru) и проверяет,
+что все бэкенды дают одинаковый результат.
+
+tick - нагрузочный тест рассылки: заполняет временную БД синтетическими
+подписчиками, выполняет один тик NotificationScheduler.check_namaz_times,
+в котором напоминание положено всем, и отправляет его через поддельного бота
+с задержкой и ответами 429. Печатает длительность тика и рассылки, скорость
+отправки, число SQL-операторов и пик памяти; результаты можно сохранить как
+базовые и сравнивать с ними последующие запуски.
+
+webhook - заменяет Telegram для бота, запущенного в режиме webhook: отправляет
+синтетические нажатия кнопок и измеряет, как быстро сервер их принимает.
+Проверяет также, что запрос с неверным секретом отклоняется.
+
+calc - время локального расчета расписания на год и, если есть БД с
+расписанием сайта, калибровка по нему и отклонение расчета по каждому намазу.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import httpx
+from telegram.error import RetryAfter
+
+from config import TIMEZONE, DISPATCH_RATE, DEFAULT_CITY, CITIES, NAMAZ_NAMES
+from database import Database
+from dispatcher import NotificationDispatcher
+from parser import NamazParser, BeautifulSoupBackend, LxmlBackend, lxml
+from schedule_service import ScheduleService
+from day_schedule import pack_day
+from prayer_times import create_engine, format_report
+import prayer_times
+from scheduler import NotificationScheduler
+
+# Объем текста вне таблицы, как на реальной странице с меню, новостями и подвалом
+PAGE_FILLER = '<p>' + 'Духовное управление мусульман Саратовской области. ' * 40 + '</p>'
+
+
+def build_regular_page(days=31):
+    """Синтетическая страница с обычной месячной таблицей"""
+    rows = ''.join(
+        f"<tr><td>{day}</td><td>пн</td><td>{day + 10}</td><td>5.{day:02d}</td><td>6.{day:02d}</td>"
+        f"<td>12.{day:02d}</td><td>15.{day:02d}</td><td>18.{day:02d}</td><td>20.{day:02d}</td></tr>"
+        for day in range(1, days + 1)
+    )
+    return (
+        '<html><head><meta charset="utf-8"></head><body>' + PAGE_FILLER * 20 +
+        '<h2>Расписание намазов</h2><table class="namaz_time">'
+        '<tr><td>Число</td><td>День</td><td>Хиджра</td><td>Фаджр</td><td>Восход</td>'
+        '<td>Зухр</td><td>Аср</td><td>Магриб</td><td>Иша</td></tr>' + rows +
+        '</table>' + PAGE_FILLER * 20 + '</body></html>'
+    ).encode('utf-8')
+
+
+def build_ramadan_page():
+    """Синтетическая страница с таблицей Рамадана (февраль/март)"""
+    days = list(range(19, 29)) + list(range(1, 21))
+    rows = ''.join(
+        f"<tr><td>{index + 1}</td><td>пн</td><td>{day}</td><td>4.{day:02d}</td><td>6.{day:02d}</td>"
+        f"<td>12.{day:02d}</td><td>15.{day:02d}</td><td>18.{day:02d}</td><td>20.{day:02d}</td></tr>"
+        for index, day in enumerate(days)
+    )
+    return (
+        '<html><head><meta charset="utf-8"></head><body>' + PAGE_FILLER * 20 +
+        '<h2>Расписание намазов на Рамадан</h2><table class="namaz_time">'
+        '<tr><td>День</td><td>Нед.</td><td>фев./март</td><td>Фаджр</td><td>Восход</td>'
+        '<td>Зухр</td><td>Аср</td><td>Магриб</td><td>Иша</td></tr>' + rows +
+        '</table>' + PAGE_FILLER * 20 + '</body></html>'
+    ).encode('utf-8')
+
+
+def available_backends():
+    backends = [BeautifulSoupBackend()]
+    if lxml is not None:
+        backends.append(LxmlBackend())
+    return backends
+
+
+def time_call(func, repeat):
+    """Лучшее время одного вызова из repeat попыток, в миллисекундах"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def bench_parse(args):
+    now = datetime.now(TIMEZONE)
+    fixtures = [
+        ('обычная', build_regular_page(), now),
+        ('рамадан (март)', build_ramadan_page(), TIMEZONE.localize(datetime(now.year, 3, 1))),
+    ]
+    for path in args.pages:
+        with open(path, 'rb') as f:
+            fixtures.append((path, f.read(), now.replace(month=args.month, day=1)))
+
+    backends = available_backends()
+    if len(backends) < 2:
+        print("⚠️ lxml не установлен, сравнивается только BeautifulSoup")
+
+    failed = False
+    for label, content, month in fixtures:
+        results = {}
+        timings = []
+        for backend in backends:
+            parser = NamazParser(backend=backend)
+            results[backend.name] = parser._parse_content(content, month)
+            ms = time_call(lambda: parser._parse_content(content, month), args.repeat)
+            timings.append(f"{backend.name} {ms:.2f} мс")
+
+        reference = results[backends[0].name]
+        identical = all(result == reference for result in results.values())
+        failed = failed or not identical or not reference
+        status = "✅" if identical and reference else "❌"
+        days = sum(len(month_days) for month_days in reference.values())
+        print(f"{status} {label}: {days} дней, " + ", ".join(timings))
+
+    if failed:
+        print("❌ Бэкенды дали разный или пустой результат")
+    return 1 if failed else 0
+
+
+# Варианты времени напоминания, как на клавиатуре бота
+OFFSETS = [5, 10, 15, 20, 30]
+
+# Метрики тика, которые сравниваются с базовыми: имя -> True, если больше - лучше
+TICK_METRICS = {
+    'tick_ms': False,
+    'fanout_s': False,
+    'sends_per_sec': True,
+    'peak_mb': False,
+}
+
+
+class FakeBot:
+    """Поддельный Telegram-бот: задержка ответа и случайные ответы 429"""
+
+    def __init__(self, latency, error_rate, retry_after, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.sent = 0
+        self.rate_limited = 0
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency * self._random.uniform(0.5, 1.5))
+        if self._random.random() < self.error_rate:
+            self.rate_limited += 1
+            raise RetryAfter(self.retry_after)
+        self.sent += 1
+        return SimpleNamespace(message_id=next(self._message_ids), chat_id=chat_id, text=text)
+
+
+def tick_schedule(minute):
+    """Расписание, в котором каждой группе offset положено напоминание в минуту minute"""
+    offsets = OFFSETS + [OFFSETS[-1] + 10]
+    return pack_day([(minute + timedelta(minutes=offset)).strftime('%H:%M') for offset in offsets])
+
+
+async def populate_users(db, count):
+    """Создает count подписчиков с разным временем напоминания"""
+    async with db._writer() as conn:
+        await conn.executemany(
+            'INSERT INTO users (user_id, subscribed, notification_offset) VALUES (?, 1, ?)',
+            ((user_id, OFFSETS[user_id % len(OFFSETS)]) for user_id in range(1, count + 1))
+        )
+        await conn.commit()
+
+
+async def run_tick(users, args, db_path):
+    db = Database(db_path)
+    await db.init_db()
+    await populate_users(db, users)
+
+    statements = 0
+
+    def count_statement(sql):
+        nonlocal statements
+        statements += 1
+
+    for conn in [db._writer_conn] + db._reader_conns:
+        await conn.set_trace_callback(count_statement)
+
+    bot = FakeBot(args.latency / 1000, args.error_rate, args.retry_after)
+    service = ScheduleService(db)
+    # Бенчмарк вызывает минутный тик напрямую
+    scheduler = NotificationScheduler(bot, db, service, mode='polling')
+    scheduler.dispatcher = NotificationDispatcher(
+        bot, rate=args.rate, concurrency=args.concurrency, on_blocked=scheduler.disable_user
+    )
+
+    try:
+        now = datetime.now(TIMEZONE)
+        minute = now.replace(second=0, microsecond=0)
+        service._days[(DEFAULT_CITY, now.date())] = tick_schedule(minute)
+
+        started = time.perf_counter()
+        await scheduler.rebuild_timeline(now)
+        index_ms = (time.perf_counter() - started) * 1000
+
+        statements = 0
+        tracemalloc.start()
+        started = time.perf_counter()
+        await scheduler.check_namaz_times()
+        tick_ms = (time.perf_counter() - started) * 1000
+        await asyncio.gather(*scheduler._dispatch_tasks)
+        await db.flush_messages()
+        fanout_s = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        batch = scheduler.dispatcher.last_batch_stats or {}
+        return {
+            'users': users,
+            'sent': bot.sent,
+            'rate_limited': bot.rate_limited,
+            'index_ms': index_ms,
+            'tick_ms': tick_ms,
+            'fanout_s': fanout_s,
+            'sends_per_sec': bot.sent / fanout_s if fanout_s > 0 else 0.0,
+            'p95_s': batch.get('p95', 0.0),
+            'sql_per_tick': statements,
+            'peak_mb': peak / 1024 / 1024,
+        }
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        await service.close()
+        await db.close()
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Сравнивает результаты с базовыми. Возвращает список описаний регрессий"""
+    regressions = []
+    for users, result in results.items():
+        base = baseline.get(users)
+        if not base:
+            continue
+        for metric, higher_is_better in TICK_METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{users} польз.: {metric} {old:.2f} -> {new:.2f} ({change:+.0%})")
+    return regressions
+
+
+def bench_tick(args):
+    now = datetime.now(TIMEZONE)
+    if (now + timedelta(minutes=OFFSETS[-1] + 12)).date() != now.date():
+        print("❌ Тик должен уложиться в текущие сутки, запустите бенчмарк после полуночи")
+        return 1
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for users in args.users:
+            result = asyncio.run(run_tick(users, args, os.path.join(tmp, f'bench_{users}.db')))
+            results[str(users)] = result
+            print(
+                f"📊 {users} польз.: тик {result['tick_ms']:.1f} мс (индекс {result['index_ms']:.1f} мс), "
+                f"рассылка {result['fanout_s']:.2f} с, {result['sends_per_sec']:.0f} сообщ./с, "
+                f"p95 {result['p95_s']:.2f} с, 429: {result['rate_limited']}, "
+                f"SQL за тик: {result['sql_per_tick']}, пик памяти {result['peak_mb']:.1f} МБ"
+            )
+            print(f"   при лимите {DISPATCH_RATE:.0f} сообщ./с рассылка займет ~{users / DISPATCH_RATE:.0f} с")
+            if result['sent'] != users:
+                print(f"❌ Отправлено {result['sent']} из {users}")
+                return 1
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"💾 Базовые результаты сохранены в {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"❌ Регрессия: {regression}")
+        if regressions:
+            return 1
+        print(f"✅ Без регрессий относительно {args.compare} (допуск {args.tolerance:.0%})")
+    return 0
+
+
+def synthetic_callback_update(update_id, user_id, data='today'):
+    """Обновление Telegram с нажатием кнопки, как его присылает Bot API"""
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Benchmark'},
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': 'Выберите действие:',
+            },
+        },
+    }
+
+
+async def post_updates(args):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    statuses = {}
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        # Запрос с неверным секретом должен быть отклонен
+        rejected = await client.post(
+            args.url, json=synthetic_callback_update(0, 1),
+            headers={'X-Telegram-Bot-Api-Secret-Token': args.secret + 'x'}
+        )
+
+        async def post(update_id):
+            update = synthetic_callback_update(update_id, 1000 + update_id % args.users)
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(args.url, json=update, headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(update_id) for update_id in range(1, args.count + 1)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return rejected.status_code, statuses, latencies, elapsed
+
+
+def bench_webhook(args):
+    rejected_status, statuses, latencies, elapsed = asyncio.run(post_updates(args))
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000
+
+    print(
+        f"📊 {args.count} обновлений за {elapsed:.2f} с ({args.count / elapsed:.0f} в секунду), "
+        f"p50 {percentile(0.5):.1f} мс, p95 {percentile(0.95):.1f} мс, макс. {latencies[-1] * 1000:.1f} мс"
+    )
+    print(f"   ответы: {statuses}")
+
+    failed = False
+    if rejected_status != 403:
+        print(f"❌ Запрос с неверным секретом не отклонен (код {rejected_status})")
+        failed = True
+    if statuses.get(200, 0) != args.count:
+        print("❌ Не все обновления приняты")
+        failed = True
+    if not failed:
+        print("✅ Все обновления приняты, неверный секрет отклонен")
+    return 1 if failed else 0
+
+
+async def load_cached_schedules(path, city):
+    db = Database(path)
+    try:
+        return await db.get_cached_schedules(city)
+    finally:
+        await db.close()
+
+
+def bench_calc(args):
+    if prayer_times.np is None:
+        print("❌ numpy не установлен")
+        return 1
+    info = CITIES.get(args.city)
+    engine = create_engine(info.get('latitude'), info.get('longitude')) if info else None
+    if engine is None:
+        print(f"❌ Нет координат города {args.city} (см. CITIES)")
+        return 1
+
+    def compute_year():
+        engine._years.clear()
+        engine.year(args.year)
+
+    ms = time_call(compute_year, args.repeat)
+    print(f"🧮 {info['name']}: {len(engine.year(args.year))} дней {args.year} года за {ms:.2f} мс")
+
+    if not args.db:
+        return 0
+    if not os.path.exists(args.db):
+        print(f"❌ БД {args.db} не найдена")
+        return 1
+    samples = asyncio.run(load_cached_schedules(args.db, args.city))
+    started = time.perf_counter()
+    report = engine.calibrate(samples)
+    calibrate_ms = (time.perf_counter() - started) * 1000
+    if not report:
+        print(f"⚠️ Калибровка: {format_report(report)}")
+        return 1
+    print(f"✅ Калибровка по {report['days']} дням за {calibrate_ms:.2f} мс")
+    for namaz_key, values in report['namaz'].items():
+        param = f", параметр {values['param']}" if values['param'] is not None else ""
+        print(f"   {NAMAZ_NAMES[namaz_key]}: поправка {values['adjustment']:+d} мин{param}, "
+              f"отклонение среднее {values['mean']:.2f}, макс. {values['max']} мин")
+    return 0
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+
+    parse_cmd = subparsers.add_parser('parse', help="Разбор HTML расписания разными бэкендами")
+    parse_cmd.add_argument('pages', nargs='*', help="Сохраненные страницы dumso.ru")
+    parse_cmd.add_argument('--month', type=int, default=time.localtime().tm_mon,
+                           help="Месяц, для которого разбираются сохраненные страницы")
+    parse_cmd.add_argument('--repeat', type=int, default=20)
+    parse_cmd.set_defaults(func=bench_parse)
+
+    tick_cmd = subparsers.add_parser('tick', help="Нагрузочный тест тика рассылки с поддельным ботом")
+    tick_cmd.add_argument('--users', type=int, nargs='+', default=[1000, 10000],
+                          help="Количество подписчиков (можно несколько, например 1000 10000 100000)")
+    tick_cmd.add_argument('--latency', type=float, default=20, help="Задержка ответа Telegram, мс")
+    tick_cmd.add_argument('--error-rate', type=float, default=0.001, help="Доля ответов 429")
+    tick_cmd.add_argument('--retry-after', type=float, default=0.1, help="retry_after в ответе 429, с")
+    tick_cmd.add_argument('--rate', type=float, default=10000,
+                          help="Лимит отправки диспетчера, сообщ./с (по умолчанию без лимита Telegram)")
+    tick_cmd.add_argument('--concurrency', type=int, default=100, help="Количество одновременных отправок")
+    tick_cmd.add_argument('--save', help="Сохранить результаты как базовые (JSON)")
+    tick_cmd.add_argument('--compare', help="Сравнить с сохраненными базовыми результатами")
+    tick_cmd.add_argument('--tolerance', type=float, default=0.2, help="Допустимое ухудшение (0.2 = 20%%)")
+    tick_cmd.set_defaults(func=bench_tick)
+
+    webhook_cmd = subparsers.add_parser('webhook', help="Отправка синтетических обновлений на webhook бота")
+    webhook_cmd.add_argument('url', help="Адрес webhook, например http://127.0.0.1:8443/telegram")
+    webhook_cmd.add_argument('--secret', required=True, help="WEBHOOK_SECRET бота")
+    webhook_cmd.add_argument('--count', type=int, default=1000, help="Количество обновлений")
+    webhook_cmd.add_argument('--users', type=int, default=100, help="Количество разных пользователей")
+    webhook_cmd.add_argument('--concurrency', type=int, default=50, help="Одновременных запросов")
+    webhook_cmd.set_defaults(func=bench_webhook)
+
+    calc_cmd = subparsers.add_parser('calc', help="Локальный расчет расписания и калибровка по БД")
+    calc_cmd.add_argument('--city', default=DEFAULT_CITY)
+    calc_cmd.add_argument('--year', type=int, default=time.localtime().tm_year)
+    calc_cmd.add_argument('--db', help="БД бота с расписанием сайта для калибровки")
+    calc_cmd.add_argument('--repeat', type=int, default=20)
+    calc_cmd.set_defaults(func=bench_calc)
+
+    args = arg_parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
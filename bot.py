@@ -1,5 +1,7 @@
 import asyncio
+import functools
 import logging
+import secrets
 from datetime import datetime, timedelta
 
 import pytz
@@ -7,10 +9,18 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
 
-from config import BOT_TOKEN, TIMEZONE, NAMAZ_NAMES, ADMIN_IDS, ADMIN_IDS
+from config import BOT_TOKEN, TIMEZONE, NAMAZ_NAMES, ADMIN_IDS, ADMIN_IDS, METRICS_HOST, METRICS_PORT
+from config import CITIES, DEFAULT_CITY
+from config import WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, UPDATE_CONCURRENCY
+from circuit_breaker import STATE_NAMES, OPEN
 from database import Database
-from parser import NamazParser
+from schedule_service import ScheduleService, resolve_city
+from day_schedule import day_times
+from prayer_times import format_report
 from scheduler import NotificationScheduler
+from metrics import HANDLER_DURATION, SUBSCRIBERS, BREAKER_OPEN, start_metrics_server
+from loop_watchdog import LoopWatchdog
+from update_processor import PerUserUpdateProcessor
 
 # Настройка логирования
 logging.basicConfig(
@@ -21,22 +31,67 @@ logger = logging.getLogger(__name__)
 
 # Глобальные объекты
 db = Database()
-parser = NamazParser()
+schedule_service = ScheduleService(db)
 scheduler = None
+metrics_server = None
+watchdog = LoopWatchdog()
 
-def format_schedule_message(schedule, date_label):
+# Пользователи, у которых сейчас удаляются уведомления
+clearing_users = set()
+
+# Бот обрабатывает только команды и нажатия кнопок, остальные обновления не запрашиваем
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+def format_schedule_message(schedule, date_label, computed=False):
     """Форматирует сообщение с расписанием"""
     if not schedule:
         return f"❌ Расписание на {date_label} не найдено"
     
-    message = f"📅 Расписание намазов на {date_label}:\n\n"
-    for namaz_key, namaz_name in NAMAZ_NAMES.items():
-        if namaz_key in schedule and schedule[namaz_key]:
-            message += f"🕌 {namaz_name}: {schedule[namaz_key]}\n"
+    times = day_times(schedule)
+    lines = [
+        f"🕌 {namaz_name}: {times[namaz_key]}\n"
+        for namaz_key, namaz_name in NAMAZ_NAMES.items()
+        if namaz_key in times
+    ]
+    message = f"📅 Расписание намазов на {date_label}:\n\n" + ''.join(lines)
+    if computed:
+        message += "\nℹ️ Расписание на эту дату еще не опубликовано, время рассчитано по координатам города"
+    return message
+
+# Готовые тексты расписания: (дата, подпись, город) -> текст.
+# Сбрасываются при обновлении расписания (schedule_service.version) и смене даты
+_schedule_messages = {}
+_schedule_messages_version = None
+
+async def get_schedule_message(date, date_label, city=DEFAULT_CITY):
+    """Возвращает текст расписания города на дату, форматируя его только один раз"""
+    global _schedule_messages_version
+    if _schedule_messages_version != schedule_service.version:
+        _schedule_messages.clear()
+        _schedule_messages_version = schedule_service.version
     
+    city = resolve_city(city)
+    key = (date, date_label, city)
+    message = _schedule_messages.get(key)
+    if message is None:
+        schedule = await schedule_service.get_day(date, city)
+        computed = bool(schedule) and schedule_service.is_computed(date, city)
+        if len(CITIES) > 1:
+            date_label = f"{date_label} ({CITIES[city]['name']})"
+        message = format_schedule_message(schedule, date_label, computed)
+        # Отсутствие расписания и расчет не кэшируем, чтобы показать расписание сайта, как только оно появится
+        if schedule and not computed:
+            for old_key in [old_key for old_key in _schedule_messages if old_key[0] < date and old_key[1:] == key[1:]]:
+                del _schedule_messages[old_key]
+            _schedule_messages[key] = message
     return message
 
-def get_main_keyboard():
+async def get_user_city(user_id):
+    """Город пользователя (из кэша пользователей)"""
+    user = await db.get_user(user_id)
+    return resolve_city(user.get('city') if user else None)
+
+def build_main_keyboard():
     """Создает главную клавиатуру с кнопками"""
     keyboard = [
         [
@@ -54,8 +109,60 @@ def get_main_keyboard():
             InlineKeyboardButton("🗑️ Очистить уведомления", callback_data="clear_notifications")
         ]
     ]
+    # Выбор города нужен, только если городов несколько
+    if len(CITIES) > 1:
+        keyboard[2].append(InlineKeyboardButton("🏙️ Город", callback_data="city"))
+    return InlineKeyboardMarkup(keyboard)
+
+def build_city_keyboard():
+    """Создает клавиатуру выбора города"""
+    keyboard = [
+        [InlineKeyboardButton(info['name'], callback_data=f"city_{city}")]
+        for city, info in CITIES.items()
+    ]
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back")])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_time_keyboard():
+    """Создает клавиатуру выбора времени напоминания"""
+    keyboard = [
+        [
+            InlineKeyboardButton("5 минут", callback_data="time_5"),
+            InlineKeyboardButton("10 минут", callback_data="time_10"),
+            InlineKeyboardButton("15 минут", callback_data="time_15")
+        ],
+        [
+            InlineKeyboardButton("20 минут", callback_data="time_20"),
+            InlineKeyboardButton("30 минут", callback_data="time_30")
+        ],
+        [
+            InlineKeyboardButton("◀️ Назад", callback_data="back")
+        ]
+    ]
     return InlineKeyboardMarkup(keyboard)
 
+# Клавиатуры неизменяемы, поэтому создаются один раз при запуске
+MAIN_KEYBOARD = build_main_keyboard()
+TIME_KEYBOARD = build_time_keyboard()
+CITY_KEYBOARD = build_city_keyboard()
+
+# callback_data кнопок бота; остальные значения попадают в метрики как other
+KNOWN_CALLBACKS = {
+    button.callback_data
+    for keyboard in (MAIN_KEYBOARD, TIME_KEYBOARD, CITY_KEYBOARD)
+    for row in keyboard.inline_keyboard
+    for button in row
+}
+
+def track_callback(handler):
+    """Записывает длительность обработки нажатия в метрики с меткой callback_data"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        data = update.callback_query.data if update.callback_query else None
+        with HANDLER_DURATION.time(callback_data=data if data in KNOWN_CALLBACKS else 'other'):
+            return await handler(update, context)
+    return wrapper
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user_id = update.effective_user.id
@@ -63,16 +170,24 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Создаем пользователя, если его нет
     await db.create_user(user_id)
     
-    welcome_message = (
-        "🕌 Ассаламу алейкум!\n\n"
-        "Я бот для напоминаний о намазах в Саратове.\n\n"
-        "Выберите действие:"
-    )
+    if len(CITIES) > 1:
+        welcome_message = (
+            "🕌 Ассаламу алейкум!\n\n"
+            "Я бот для напоминаний о намазах.\n"
+            "Город можно выбрать кнопкой «🏙️ Город».\n\n"
+            "Выберите действие:"
+        )
+    else:
+        welcome_message = (
+            "🕌 Ассаламу алейкум!\n\n"
+            "Я бот для напоминаний о намазах в Саратове.\n\n"
+            "Выберите действие:"
+        )
     
     # Отправляем сообщение с меню
     sent_message = await update.message.reply_text(
         welcome_message,
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
     
     # Закрепляем сообщение
@@ -84,33 +199,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Ошибка закрепления сообщения: {e}")
 
+@track_callback
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на кнопки"""
     query = update.callback_query
-    await query.answer()
+    # На нажатие "Очистить уведомления" отвечаем результатом ниже
+    if query.data != "clear_notifications":
+        await query.answer()
     
     user_id = query.from_user.id
     await db.create_user(user_id)
     
     if query.data == "today":
         try:
-            schedule = parser.get_today_schedule()
-            # Если расписание пустое, пытаемся получить из БД
-            if not schedule:
-                now = datetime.now(TIMEZONE)
-                schedule = await db.get_schedule(now.day, now.month, now.year)
-            message = format_schedule_message(schedule, "сегодня")
+            # Память -> БД -> сайт
+            message = await get_schedule_message(datetime.now(TIMEZONE).date(), "сегодня", await get_user_city(user_id))
         except Exception as e:
             logger.error(f"Ошибка получения расписания на сегодня: {e}")
-            # Пытаемся получить из БД
-            try:
-                now = datetime.now(TIMEZONE)
-                schedule = await db.get_schedule(now.day, now.month, now.year)
-                message = format_schedule_message(schedule, "сегодня")
-            except Exception:
-                message = "❌ Не удалось получить расписание. Попробуйте позже."
+            message = "❌ Не удалось получить расписание. Попробуйте позже."
         try:
-            await query.edit_message_text(message, reply_markup=get_main_keyboard())
+            await query.edit_message_text(message, reply_markup=MAIN_KEYBOARD)
         except BadRequest as e:
             # Игнорируем ситуацию, когда сообщение не изменилось
             if "Message is not modified" in str(e):
@@ -122,25 +230,14 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif query.data == "tomorrow":
         try:
-            schedule = parser.get_tomorrow_schedule()
-            # Если расписание пустое, пытаемся получить из БД
-            if not schedule:
-                now = datetime.now(TIMEZONE)
-                tomorrow_dt = now + timedelta(days=1)
-                schedule = await db.get_schedule(tomorrow_dt.day, tomorrow_dt.month, tomorrow_dt.year)
-            message = format_schedule_message(schedule, "завтра")
+            # Память -> БД -> сайт
+            tomorrow = datetime.now(TIMEZONE).date() + timedelta(days=1)
+            message = await get_schedule_message(tomorrow, "завтра", await get_user_city(user_id))
         except Exception as e:
             logger.error(f"Ошибка получения расписания на завтра: {e}")
-            # Пытаемся получить из БД
-            try:
-                now = datetime.now(TIMEZONE)
-                tomorrow_dt = now + timedelta(days=1)
-                schedule = await db.get_schedule(tomorrow_dt.day, tomorrow_dt.month, tomorrow_dt.year)
-                message = format_schedule_message(schedule, "завтра")
-            except Exception:
-                message = "❌ Не удалось получить расписание. Попробуйте позже."
+            message = "❌ Не удалось получить расписание. Попробуйте позже."
         try:
-            await query.edit_message_text(message, reply_markup=get_main_keyboard())
+            await query.edit_message_text(message, reply_markup=MAIN_KEYBOARD)
         except BadRequest as e:
             if "Message is not modified" in str(e):
                 pass  # Тихо игнорируем
@@ -151,10 +248,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif query.data == "subscribe":
         await db.subscribe_user(user_id)
+        if scheduler:
+            await scheduler.refresh_user(user_id)
         try:
             await query.edit_message_text(
                 "✅ Вы подписались на уведомления о намазах!",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
         except BadRequest as e:
             if "Message is not modified" in str(e):
@@ -166,10 +265,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif query.data == "unsubscribe":
         await db.unsubscribe_user(user_id)
+        if scheduler:
+            await scheduler.refresh_user(user_id)
         try:
             await query.edit_message_text(
                 "❌ Вы отписались от уведомлений о намазах.",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
         except BadRequest as e:
             if "Message is not modified" in str(e):
@@ -180,26 +281,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.error(f"Неожиданная ошибка редактирования сообщения (unsubscribe): {e}")
     
     elif query.data == "set_time":
-        # Создаем клавиатуру для выбора времени
-        keyboard = [
-            [
-                InlineKeyboardButton("5 минут", callback_data="time_5"),
-                InlineKeyboardButton("10 минут", callback_data="time_10"),
-                InlineKeyboardButton("15 минут", callback_data="time_15")
-            ],
-            [
-                InlineKeyboardButton("20 минут", callback_data="time_20"),
-                InlineKeyboardButton("30 минут", callback_data="time_30")
-            ],
-            [
-                InlineKeyboardButton("◀️ Назад", callback_data="back")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         try:
             await query.edit_message_text(
                 "⏰ Выберите время напоминания до намаза:",
-                reply_markup=reply_markup
+                reply_markup=TIME_KEYBOARD
             )
         except BadRequest as e:
             if "Message is not modified" in str(e):
@@ -212,10 +297,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data.startswith("time_"):
         offset = int(query.data.split("_")[1])
         await db.set_notification_offset(user_id, offset)
+        if scheduler:
+            await scheduler.refresh_user(user_id)
         try:
             await query.edit_message_text(
                 f"✅ Время напоминания установлено: {offset} минут",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
         except BadRequest as e:
             if "Message is not modified" in str(e):
@@ -225,11 +312,46 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Неожиданная ошибка редактирования сообщения (time_*): {e}")
     
+    elif query.data == "city":
+        try:
+            await query.edit_message_text(
+                "🏙️ Выберите город:",
+                reply_markup=CITY_KEYBOARD
+            )
+        except BadRequest as e:
+            if "Message is not modified" in str(e):
+                pass  # Тихо игнорируем
+            else:
+                logger.error(f"Ошибка редактирования сообщения (city): {e}")
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка редактирования сообщения (city): {e}")
+    
+    elif query.data.startswith("city_"):
+        city = query.data[len("city_"):]
+        # Кнопка могла остаться от города, которого больше нет в CITIES
+        if city not in CITIES:
+            return
+        await db.set_user_city(user_id, city)
+        if scheduler:
+            await scheduler.refresh_user(user_id)
+        try:
+            await query.edit_message_text(
+                f"✅ Город установлен: {CITIES[city]['name']}",
+                reply_markup=MAIN_KEYBOARD
+            )
+        except BadRequest as e:
+            if "Message is not modified" in str(e):
+                pass  # Тихо игнорируем
+            else:
+                logger.error(f"Ошибка редактирования сообщения (city_*): {e}")
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка редактирования сообщения (city_*): {e}")
+    
     elif query.data == "back":
         try:
             await query.edit_message_text(
                 "Выберите действие:",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
         except BadRequest as e:
             if "Message is not modified" in str(e):
@@ -248,46 +370,41 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.answer("✅ Нет уведомлений для удаления", show_alert=False)
                 return
             
-            # Удаляем сообщения
-            deleted_count = 0
-            for msg_id in message_ids:
-                try:
-                    await context.bot.delete_message(chat_id=user_id, message_id=msg_id)
-                    deleted_count += 1
-                except Exception as e:
-                    # Сообщение уже удалено или недоступно
-                    logger.debug(f"Не удалось удалить сообщение {msg_id}: {e}")
-            
-            # Удаляем из БД
-            await db.delete_messages([(msg_id, user_id) for msg_id in message_ids])
+            if user_id in clearing_users:
+                await query.answer("🗑️ Уведомления уже удаляются", show_alert=False)
+                return
             
-            await query.answer(
-                f"✅ Удалено {deleted_count} уведомлений",
-                show_alert=False
-            )
+            # Удаление может занять долго (лимиты Telegram), поэтому идет в фоне
+            clearing_users.add(user_id)
+            context.application.create_task(clear_user_notifications(user_id, message_ids))
+            await query.answer(f"🗑️ Удаляю {len(message_ids)} уведомлений", show_alert=False)
         except Exception as e:
             logger.error(f"Ошибка очистки уведомлений: {e}")
             await query.answer("❌ Ошибка при удалении уведомлений", show_alert=False)
 
+async def clear_user_notifications(user_id, message_ids):
+    """Фоновое удаление уведомлений пользователя из чата и из БД"""
+    try:
+        # Удаляем сообщения (пачками, если Bot API это позволяет)
+        deleted_count = await scheduler.dispatcher.delete_messages(user_id, message_ids)
+        
+        # Удаляем из БД
+        await db.delete_messages([(msg_id, user_id) for msg_id in message_ids])
+        logger.info(f"Пользователь {user_id}: удалено {deleted_count} из {len(message_ids)} уведомлений")
+    except Exception as e:
+        logger.error(f"Ошибка очистки уведомлений пользователя {user_id}: {e}")
+    finally:
+        clearing_users.discard(user_id)
+
 async def schedule_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /schedule"""
     try:
-        schedule = parser.get_today_schedule()
-        # Если расписание пустое, пытаемся получить из БД
-        if not schedule:
-            now = datetime.now(TIMEZONE)
-            schedule = await db.get_schedule(now.day, now.month, now.year)
-        message = format_schedule_message(schedule, "сегодня")
+        city = await get_user_city(update.effective_user.id)
+        message = await get_schedule_message(datetime.now(TIMEZONE).date(), "сегодня", city)
     except Exception as e:
         logger.error(f"Ошибка получения расписания: {e}")
-        # Пытаемся получить из БД
-        try:
-            now = datetime.now(TIMEZONE)
-            schedule = await db.get_schedule(now.day, now.month, now.year)
-            message = format_schedule_message(schedule, "сегодня")
-        except:
-            message = "❌ Не удалось получить расписание. Попробуйте позже."
-    await update.message.reply_text(message, reply_markup=get_main_keyboard())
+        message = "❌ Не удалось получить расписание. Попробуйте позже."
+    await update.message.reply_text(message, reply_markup=MAIN_KEYBOARD)
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /status"""
@@ -297,15 +414,17 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user:
         status = "подписан" if user['subscribed'] else "не подписан"
         offset = user.get('notification_offset', 10)
+        city = resolve_city(user.get('city'))
         message = (
             f"📊 Ваш статус:\n\n"
+            f"Город: {CITIES[city]['name']}\n"
             f"Подписка: {status}\n"
             f"Время напоминания: {offset} минут"
         )
     else:
         message = "❌ Пользователь не найден"
     
-    await update.message.reply_text(message, reply_markup=get_main_keyboard())
+    await update.message.reply_text(message, reply_markup=MAIN_KEYBOARD)
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /stats (только для администраторов)"""
@@ -335,6 +454,26 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 count = stats['offset_distribution'][offset]
                 message += f"   {offset} мин: {count} чел.\n"
         
+        if len(CITIES) > 1 and stats['city_distribution']:
+            message += "\n🏙️ **Подписчики по городам:**\n"
+            for city, count in sorted(stats['city_distribution'].items(), key=lambda item: -item[1]):
+                name = CITIES[city]['name'] if city in CITIES else city
+                message += f"   {name}: {count} чел.\n"
+        
+        if scheduler and scheduler.dispatch_mode == 'outbox':
+            outbox = await db.get_outbox_stats()
+            message += (
+                f"\n📥 **Очередь рассылки:** ожидают {outbox.get('pending', 0)}, "
+                f"отправлено {outbox.get('done', 0)}, ошибок {outbox.get('failed', 0)}, "
+                f"просрочено {outbox.get('expired', 0)}\n"
+            )
+        
+        cache_stats = db.user_cache_stats()
+        message += (
+            f"\n💾 **Кэш пользователей:** {cache_stats['size']}/{cache_stats['max_size']}\n"
+            f"   Попаданий: {cache_stats['hits']}, промахов: {cache_stats['misses']}\n"
+        )
+        
         await update.message.reply_text(message, parse_mode='Markdown')
         
     except Exception as e:
@@ -353,42 +492,125 @@ async def update_schedule_command(update: Update, context: ContextTypes.DEFAULT_
     try:
         await update.message.reply_text("🔄 Обновляю расписание с сайта...")
         
-        # Принудительно парсим сайт
-        schedule = parser.parse_schedule(force_refresh=True)
+        # Принудительно парсим сайт, все города параллельно (все полученные месяцы сохраняются в БД)
+        schedules = await schedule_service.refresh()
         
-        if not schedule or len(schedule) == 0:
-            await update.message.reply_text("❌ Не удалось получить расписание с сайта.")
+        if not any(schedules.values()):
+            await update.message.reply_text(
+                "❌ Не удалось получить расписание с сайта.\n\n" + format_breakers_status()
+            )
             return
         
-        # Сохраняем в БД
         now = datetime.now(TIMEZONE)
-        await db.save_schedule(schedule, now.month, now.year)
         
-        # Обновляем расписание в планировщике, если он запущен
+        # Обновляем индекс уведомлений в планировщике, если он запущен
         if scheduler:
-            await scheduler.update_schedule_daily()
+            await scheduler.rebuild_timeline()
         
+        lines = [
+            f"{'📅' if schedule else '❌'} {CITIES[city]['name']}: "
+            + (f"{len(schedule)} дней" if schedule else "не удалось получить")
+            for city, schedule in schedules.items()
+        ]
         await update.message.reply_text(
-            f"✅ Расписание успешно обновлено!\n"
-            f"📅 Получено расписание на {len(schedule)} дней для {now.month}/{now.year}"
+            f"✅ Расписание успешно обновлено для {now.month}/{now.year}!\n" + "\n".join(lines)
         )
         
     except Exception as e:
         logger.error(f"Ошибка обновления расписания: {e}")
         await update.message.reply_text(f"❌ Ошибка обновления расписания: {e}")
 
+def format_breaker_status(status):
+    """Форматирует состояние предохранителя запросов к сайту"""
+    message = (
+        f"🌐 Сайт {status['name']}\n"
+        f"Состояние: {STATE_NAMES.get(status['state'], status['state'])}\n"
+        f"Ошибок подряд: {status['failures']}\n"
+    )
+    if status['last_error']:
+        message += f"Последняя ошибка: {status['last_error']}\n"
+    if status['last_failure_at']:
+        message += f"Время ошибки: {status['last_failure_at'].strftime('%d.%m %H:%M:%S')}\n"
+    if status['next_retry_at']:
+        message += f"Следующая попытка: {status['next_retry_at'].strftime('%d.%m %H:%M:%S')}\n"
+    return message
+
+def format_breakers_status():
+    """Состояние предохранителей всех сайтов расписания"""
+    return "\n".join(format_breaker_status(breaker.status()) for breaker in schedule_service.breakers().values())
+
+async def fetch_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /fetch_status (только для администраторов)"""
+    user_id = update.effective_user.id
+    
+    # Проверка на администратора
+    if not ADMIN_IDS or user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    message = format_breakers_status()
+    for city, engine in schedule_service.engines.items():
+        message += f"\n🧮 Локальный расчет ({CITIES[city]['name']}): {format_report(engine.report)}\n"
+    await update.message.reply_text(message)
+
+def format_loop_status(stats):
+    """Форматирует задержку event loop и места, где он блокировался"""
+    message = (
+        f"⏱️ Задержка event loop (последние {stats['samples']} замеров):\n"
+        f"p50 {stats['p50'] * 1000:.1f} мс, p95 {stats['p95'] * 1000:.1f} мс, "
+        f"p99 {stats['p99'] * 1000:.1f} мс, макс. {stats['max'] * 1000:.0f} мс\n"
+        f"Блокировок дольше {stats['threshold'] * 1000:.0f} мс: {stats['stalls']}\n"
+    )
+    for index, offender in enumerate(stats['offenders'], 1):
+        message += (
+            f"\n{index}. {offender['location']}\n"
+            f"   {offender['count']} раз, макс. {offender['max_lag']:.2f} с, всего {offender['total_lag']:.2f} с\n"
+            f"   " + " → ".join(offender['stack']) + "\n"
+        )
+    return message
+
+async def loop_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /loop_status (только для администраторов)"""
+    user_id = update.effective_user.id
+    
+    # Проверка на администратора
+    if not ADMIN_IDS or user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+    
+    await update.message.reply_text(format_loop_status(watchdog.stats()))
+
 async def post_init(application: Application):
     """Инициализация после запуска бота"""
-    global scheduler
+    global scheduler, metrics_server
+    watchdog.start()
+    await db.connect()
     await db.init_db()
-    scheduler = NotificationScheduler(application.bot, db)
+    scheduler = NotificationScheduler(application.bot, db, schedule_service)
     await scheduler.start()
+    
+    SUBSCRIBERS.set_function(lambda: len(scheduler._user_groups))
+    BREAKER_OPEN.set_function(lambda: {
+        host: int(breaker.state == OPEN) for host, breaker in schedule_service.breakers().items()
+    })
+    if METRICS_PORT:
+        metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT)
     logger.info("Бот запущен и готов к работе")
 
-async def post_shutdown(application: Application):
-    """Очистка при остановке бота"""
+async def post_stop(application: Application):
+    """Остановка планировщика и рассылок, пока клиент Telegram еще открыт"""
     if scheduler:
         scheduler.stop()
+        await scheduler.drain()
+
+async def post_shutdown(application: Application):
+    """Очистка при остановке бота"""
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await watchdog.stop()
+    await schedule_service.close()
+    await db.close()
     logger.info("Бот остановлен")
 
 def main():
@@ -398,7 +620,13 @@ def main():
         return
     
     # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
+    builder = (
+        Application.builder().token(BOT_TOKEN)
+        .post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    )
+    if UPDATE_CONCURRENCY > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+    application = builder.build()
     
     # Регистрируем обработчики
     application.add_handler(CommandHandler("start", start))
@@ -406,11 +634,28 @@ def main():
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("update_schedule", update_schedule_command))
+    application.add_handler(CommandHandler("fetch_status", fetch_status_command))
+    application.add_handler(CommandHandler("loop_status", loop_status_command))
     application.add_handler(CallbackQueryHandler(button_handler))
     
-    # Запускаем бота
-    logger.info("Запуск бота...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Запускаем бота. При остановке сначала закрывается прием обновлений и обрабатываются
+    # уже полученные, затем post_stop останавливает планировщик и дожидается рассылок
+    # (клиент Telegram еще открыт), после закрытия клиента post_shutdown закрывает БД
+    if WEBHOOK_URL:
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        logger.info(f"Запуск бота в режиме webhook ({webhook_url}, порт {WEBHOOK_PORT})...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=webhook_url,
+            # Запросы без правильного секрета отклоняются с кодом 403
+            secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        logger.info("Запуск бота...")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == '__main__':
     main()
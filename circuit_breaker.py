@@ -0,0 +1,102 @@
+import random
+import time
+from datetime import datetime
+
+from config import TIMEZONE
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Сколько секунд ждать результата пробного запроса в полуоткрытом состоянии
+TRIAL_TIMEOUT = 60
+
+STATE_NAMES = {
+    CLOSED: 'закрыт (запросы разрешены)',
+    OPEN: 'открыт (запросы заблокированы)',
+    HALF_OPEN: 'полуоткрыт (пробный запрос)',
+}
+
+
+class CircuitBreaker:
+    """Предохранитель для запросов к сайту с экспоненциальной задержкой и jitter.
+
+    После failure_threshold ошибок подряд запросы блокируются на base_delay секунд,
+    каждая следующая неудачная проба удваивает задержку (не больше max_delay).
+    """
+
+    def __init__(self, name, failure_threshold=2, base_delay=60, max_delay=3600, jitter=0.2):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.state = CLOSED
+        self.failures = 0
+        self.last_error = None
+        self.last_failure_at = None
+        self.next_retry_at = None
+        self._opened_count = 0
+        self._trial_in_flight = False
+        self._trial_started_at = 0.0
+
+    def allow(self):
+        """Можно ли сейчас выполнить запрос"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.time() >= self.next_retry_at:
+            self.state = HALF_OPEN
+            self._trial_in_flight = False
+        # В полуоткрытом состоянии пропускаем только один пробный запрос
+        # (если проба оборвалась без результата, через TRIAL_TIMEOUT разрешаем новую)
+        if self.state == HALF_OPEN and (
+            not self._trial_in_flight or time.time() - self._trial_started_at > TRIAL_TIMEOUT
+        ):
+            self._trial_in_flight = True
+            self._trial_started_at = time.time()
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            print(f"✅ {self.name}: соединение восстановлено")
+        self.state = CLOSED
+        self.failures = 0
+        self.next_retry_at = None
+        self._opened_count = 0
+        self._trial_in_flight = False
+
+    def record_failure(self, error):
+        self.failures += 1
+        self.last_error = str(error)
+        self.last_failure_at = time.time()
+        self._trial_in_flight = False
+        # Запросы, начатые до открытия (предохранитель общий для нескольких
+        # городов), не должны увеличивать задержку повторно
+        if self.state == OPEN:
+            return
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        delay = min(self.max_delay, self.base_delay * 2 ** self._opened_count)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self._opened_count += 1
+        self.state = OPEN
+        self.next_retry_at = time.time() + delay
+        print(f"⚠️ {self.name}: запросы приостановлены на {delay:.0f} с ({self.last_error})")
+
+    def status(self):
+        """Состояние предохранителя для администраторов"""
+        return {
+            'name': self.name,
+            'state': self.state,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_failure_at': _to_datetime(self.last_failure_at),
+            'next_retry_at': _to_datetime(self.next_retry_at) if self.state == OPEN else None,
+        }
+
+
+def _to_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, TIMEZONE) if timestamp else None
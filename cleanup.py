@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from config import CLEANUP_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Имя задачи в таблице cleanup_progress
+CLEANUP_NAME = 'notifications'
+
+
+class NotificationCleaner:
+    """Автоочистка старых уведомлений.
+
+    Читает кандидатов из БД страницами, удаляет их в Telegram через пул воркеров
+    диспетчера (общий лимит скорости с рассылкой) и после каждой страницы удаляет
+    строки из БД и сохраняет прогресс. Прерванная очистка продолжается с тем же
+    порогом даты: необработанные сообщения остаются в БД.
+    """
+
+    def __init__(self, db, dispatcher, page_size=CLEANUP_PAGE_SIZE):
+        self.db = db
+        self.dispatcher = dispatcher
+        self.page_size = page_size
+        self._running = False
+
+    async def has_unfinished(self):
+        return await self.db.get_cleanup_progress(CLEANUP_NAME) is not None
+
+    async def run(self, days=2):
+        """Удаляет уведомления старше days дней. Возвращает (удалено, не удалось)"""
+        if self._running:
+            print("⚠️ Автоочистка уже выполняется")
+            return None
+        self._running = True
+        try:
+            return await self._run(days)
+        finally:
+            self._running = False
+
+    async def _run(self, days):
+        progress = await self.db.get_cleanup_progress(CLEANUP_NAME)
+        if progress:
+            cutoff = progress['cutoff']
+            deleted, failed = progress['deleted'], progress['failed']
+            print(f"🔄 Продолжаем прерванную автоочистку (удалено {deleted}, не удалось {failed})")
+        else:
+            # created_at хранится в UTC (CURRENT_TIMESTAMP)
+            cutoff = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+            deleted = failed = 0
+
+        started = time.monotonic()
+        while True:
+            page = await self.db.get_old_messages_page(cutoff, self.page_size)
+            if not page:
+                break
+            # Первая страница создает запись о прогрессе до удаления в Telegram
+            await self.db.save_cleanup_progress(CLEANUP_NAME, cutoff, deleted, failed)
+
+            page_deleted = await self._delete_page(page)
+            deleted += page_deleted
+            failed += len(page) - page_deleted
+
+            # Удаляем из БД все сообщения страницы (включая те, что не удалось удалить)
+            await self.db.delete_messages(page)
+            await self.db.save_cleanup_progress(CLEANUP_NAME, cutoff, deleted, failed)
+
+        await self.db.clear_cleanup_progress(CLEANUP_NAME)
+        if deleted or failed:
+            print(
+                f"✅ Автоочистка: удалено {deleted} уведомлений, не удалось {failed} "
+                f"({time.monotonic() - started:.1f} с)"
+            )
+        else:
+            print("Нет старых уведомлений для удаления")
+        return deleted, failed
+
+    async def _delete_page(self, page):
+        """Удаляет страницу сообщений в Telegram, группируя их по чатам"""
+        by_chat = {}
+        for message_id, user_id in page:
+            by_chat.setdefault(user_id, []).append(message_id)
+
+        chats = iter(by_chat.items())
+        deleted = 0
+
+        async def worker():
+            nonlocal deleted
+            for chat_id, message_ids in chats:
+                try:
+                    count = await self.dispatcher.delete_messages(chat_id, message_ids)
+                    deleted += count
+                except Exception as e:
+                    logger.error(f"Ошибка удаления сообщений в чате {chat_id}: {e}")
+
+        workers = min(self.dispatcher.concurrency, len(by_chat))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        return deleted
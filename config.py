@@ -5,9 +5,83 @@ import pytz
 load_dotenv()
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+
+# Сколько обновлений обрабатывать одновременно (обновления одного пользователя - всегда по очереди).
+# 1 - последовательная обработка
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 32))
 NOTIFICATION_OFFSET = int(os.getenv('NOTIFICATION_OFFSET', 10))
 TIMEZONE = pytz.timezone(os.getenv('TIMEZONE', 'Europe/Saratov'))
 
+# Получение обновлений: без WEBHOOK_URL - long polling, иначе webhook со встроенным HTTP-сервером.
+# WEBHOOK_URL - публичный адрес, на который Telegram отправляет обновления (https://bot.example.com)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+# Секрет в заголовке X-Telegram-Bot-Api-Secret-Token; если не задан, генерируется при запуске
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+
+# Города: ключ|название|адрес страницы расписания[|широта|долгота], через запятую.
+# Координаты нужны для локального расчета, если сайт недоступен. Все города
+# используют один часовой пояс TIMEZONE
+cities_str = os.getenv('CITIES', 'saratov|Саратов|https://dumso.ru/raspisanie|51.5331|46.0342')
+CITIES = {}
+for city_str in cities_str.split(','):
+    parts = [part.strip() for part in city_str.split('|')]
+    if len(parts) in (3, 5) and all(parts):
+        CITIES[parts[0]] = {'name': parts[1], 'url': parts[2], 'latitude': None, 'longitude': None}
+        if len(parts) == 5:
+            CITIES[parts[0]].update(latitude=float(parts[3]), longitude=float(parts[4]))
+if not CITIES:
+    CITIES['saratov'] = {'name': 'Саратов', 'url': 'https://dumso.ru/raspisanie',
+                         'latitude': 51.5331, 'longitude': 46.0342}
+# Город новых пользователей (и всех пользователей до появления выбора города)
+DEFAULT_CITY = os.getenv('DEFAULT_CITY', next(iter(CITIES), 'saratov'))
+
+# Сколько страниц расписания загружать одновременно с одного сайта
+FETCH_PER_HOST = int(os.getenv('FETCH_PER_HOST', 2))
+
+# Снимок расписания (python snapshot.py export ...), который загружается в БД при запуске.
+# Бот сразу работает по нему, а расписание на сайте проверяет в фоне
+SCHEDULE_SNAPSHOT = os.getenv('SCHEDULE_SNAPSHOT', '')
+
+# Рассчитывать время намазов по координатам города, если расписания нет ни в БД, ни на сайте (нужен numpy)
+CALC_FALLBACK = os.getenv('CALC_FALLBACK', '1') == '1'
+
+# Рассылка уведомлений: общий лимит Telegram ~30 сообщений/с и ~1 сообщение/с в один чат
+DISPATCH_RATE = float(os.getenv('DISPATCH_RATE', 30))
+DISPATCH_CONCURRENCY = int(os.getenv('DISPATCH_CONCURRENCY', 20))
+DISPATCH_CHAT_INTERVAL = float(os.getenv('DISPATCH_CHAT_INTERVAL', 1))
+DISPATCH_MAX_RETRIES = int(os.getenv('DISPATCH_MAX_RETRIES', 3))
+
+# Запуск напоминаний: exact - разовые задачи точно на время отправки,
+# polling - проверка расписания каждую минуту
+NOTIFICATION_MODE = os.getenv('NOTIFICATION_MODE', 'exact')
+
+# Где отправляются напоминания: inline - в процессе бота, outbox - планировщик пишет
+# их в очередь в БД, а отправляют отдельные процессы (python outbox_worker.py)
+DISPATCH_MODE = os.getenv('DISPATCH_MODE', 'inline')
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 2))
+OUTBOX_BATCH = int(os.getenv('OUTBOX_BATCH', 50))
+OUTBOX_LEASE = float(os.getenv('OUTBOX_LEASE', 120))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1))
+# Сколько раз задачу можно захватить, прежде чем она будет помечена ошибкой
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 3))
+
+# Бэкенд разбора HTML расписания: auto (lxml, если установлен), lxml или bs4
+PARSER_BACKEND = os.getenv('PARSER_BACKEND', 'auto')
+
+# Автоочистка уведомлений: сколько сообщений читать из БД за один проход
+CLEANUP_PAGE_SIZE = int(os.getenv('CLEANUP_PAGE_SIZE', 1000))
+
+# HTTP-сервер метрик Prometheus (/metrics). 0 - сервер не запускается
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+# Контроль задержки event loop: период проверки и порог блокировки, секунд
+WATCHDOG_INTERVAL = float(os.getenv('WATCHDOG_INTERVAL', 0.1))
+WATCHDOG_THRESHOLD = float(os.getenv('WATCHDOG_THRESHOLD', 0.25))
+
 # Названия намазов на русском
 NAMAZ_NAMES = {
     'fajr': 'Фаджр',
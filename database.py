@@ -1,145 +1,543 @@
 import aiosqlite
 import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
 
+from config import DEFAULT_CITY, NAMAZ_ORDER
+from day_schedule import MISSING, pack_day
+from metrics import DB_QUERY_DURATION, timed
+
+# Настройки соединений SQLite: WAL позволяет читать параллельно с записью
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',  # ~16 МБ
+    'PRAGMA mmap_size = 67108864',  # 64 МБ
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# Количество пар (message_id, user_id) в одном DELETE (лимит параметров SQLite - 999)
+DELETE_CHUNK = 400
+
+def _minutes_sql(column):
+    """SQL-выражение, переводящее 'HH:MM' в минуты от полуночи (NULL, если времени нет)"""
+    return (
+        f"CASE WHEN instr({column}, ':') > 0 THEN "
+        f"CAST(substr({column}, 1, instr({column}, ':') - 1) AS INTEGER) * 60 + "
+        f"CAST(substr({column}, instr({column}, ':') + 1) AS INTEGER) END"
+    )
+
+def _schedule_params(city, year, month, day, times):
+    """Параметры SCHEDULE_INSERT_QUERY для дня расписания (MISSING -> NULL)"""
+    return (city, year, month, day, *(None if minutes == MISSING else minutes for minutes in times))
+
+def _schedule_row(row):
+    """(date, расписание дня) из строки SCHEDULE_SELECT_QUERY"""
+    return (datetime(row['year'], row['month'], row['day']).date(),
+            pack_day([row[namaz_key] for namaz_key in NAMAZ_ORDER]))
+
+# Миграции схемы: (версия, список SQL). Текущая версия хранится в PRAGMA user_version.
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            subscribed INTEGER DEFAULT 0,
+            notification_offset INTEGER DEFAULT 10,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS schedule_cache (
+            month INTEGER,
+            year INTEGER,
+            day INTEGER,
+            fajr TEXT,
+            sunrise TEXT,
+            dhuhr TEXT,
+            asr TEXT,
+            maghrib TEXT,
+            isha TEXT,
+            PRIMARY KEY (year, month, day)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id INTEGER,
+            user_id INTEGER,
+            message_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (message_id, user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS pinned_messages (
+            user_id INTEGER PRIMARY KEY,
+            message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS deliveries (
+            day INTEGER,
+            user_id INTEGER,
+            namaz_key TEXT,
+            PRIMARY KEY (day, user_id, namaz_key)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (2, [
+        # Подписчики для планировщика (user_id входит в индекс как rowid)
+        'CREATE INDEX IF NOT EXISTS idx_users_subscribed ON users (subscribed, notification_offset)',
+        # Подсчет новых пользователей в /stats
+        'CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)',
+        # Автоочистка старых уведомлений
+        'CREATE INDEX IF NOT EXISTS idx_messages_type_created ON messages (message_type, created_at, message_id, user_id)',
+        # Очистка уведомлений конкретного пользователя
+        'CREATE INDEX IF NOT EXISTS idx_messages_user_type ON messages (user_id, message_type, message_id)',
+    ]),
+    (3, [
+        # Прогресс автоочистки: незавершенная очистка продолжается после перезапуска
+        '''
+        CREATE TABLE IF NOT EXISTS cleanup_progress (
+            name TEXT PRIMARY KEY,
+            cutoff TEXT,
+            deleted INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (4, [
+        # Очередь напоминаний для отдельных процессов рассылки (DISPATCH_MODE=outbox)
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            day INTEGER,
+            user_id INTEGER,
+            namaz_key TEXT,
+            namaz_time TEXT,
+            notification_offset INTEGER,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            lease_owner TEXT,
+            lease_until REAL DEFAULT 0,
+            UNIQUE (day, user_id, namaz_key)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, lease_until, id)',
+    ]),
+    (5, [
+        # Несколько городов: город пользователя и расписание по городам.
+        # Город по умолчанию задается окружением, поэтому он передается параметром
+        # и не попадает в схему (DEFAULT столбца зафиксировал бы значение навсегда)
+        'ALTER TABLE users ADD COLUMN city TEXT',
+        ('UPDATE users SET city = ? WHERE city IS NULL', (DEFAULT_CITY,)),
+        'DROP INDEX IF EXISTS idx_users_subscribed',
+        'CREATE INDEX IF NOT EXISTS idx_users_subscribed ON users (subscribed, city, notification_offset)',
+        '''
+        CREATE TABLE schedule_cache_new (
+            city TEXT,
+            month INTEGER,
+            year INTEGER,
+            day INTEGER,
+            fajr TEXT,
+            sunrise TEXT,
+            dhuhr TEXT,
+            asr TEXT,
+            maghrib TEXT,
+            isha TEXT,
+            PRIMARY KEY (city, year, month, day)
+        )
+        ''',
+        ('''
+        INSERT INTO schedule_cache_new (city, month, year, day, fajr, sunrise, dhuhr, asr, maghrib, isha)
+        SELECT ?, month, year, day, fajr, sunrise, dhuhr, asr, maghrib, isha FROM schedule_cache
+        ''', (DEFAULT_CITY,)),
+        'DROP TABLE schedule_cache',
+        'ALTER TABLE schedule_cache_new RENAME TO schedule_cache',
+    ]),
+    (6, [
+        # Времена намазов в минутах от полуночи вместо строк 'HH:MM'
+        '''
+        CREATE TABLE schedule_cache_new (
+            city TEXT,
+            month INTEGER,
+            year INTEGER,
+            day INTEGER,
+            fajr INTEGER,
+            sunrise INTEGER,
+            dhuhr INTEGER,
+            asr INTEGER,
+            maghrib INTEGER,
+            isha INTEGER,
+            PRIMARY KEY (city, year, month, day)
+        )
+        ''',
+        f'''
+        INSERT INTO schedule_cache_new (city, month, year, day, fajr, sunrise, dhuhr, asr, maghrib, isha)
+        SELECT city, month, year, day, {', '.join(_minutes_sql(namaz_key) for namaz_key in NAMAZ_ORDER)}
+        FROM schedule_cache
+        ''',
+        'DROP TABLE schedule_cache',
+        'ALTER TABLE schedule_cache_new RENAME TO schedule_cache',
+    ]),
+    (7, [
+        # Напоминание по локальному расчету (процесс рассылки добавляет пометку в текст)
+        'ALTER TABLE outbox ADD COLUMN computed INTEGER DEFAULT 0',
+    ]),
+]
+
+SUBSCRIBED_USERS_QUERY = 'SELECT user_id, subscribed, city, notification_offset FROM users WHERE subscribed = 1'
+OLD_MESSAGES_QUERY = '''
+    SELECT message_id, user_id FROM messages 
+    WHERE message_type = 'notification'
+    AND created_at < datetime('now', '-' || ? || ' days')
+'''
+OLD_MESSAGES_PAGE_QUERY = '''
+    SELECT message_id, user_id FROM messages
+    WHERE message_type = 'notification' AND created_at < ?
+    ORDER BY created_at
+    LIMIT ?
+'''
+# Захват задач очереди одним оператором: несколько процессов не получат одну задачу дважды
+CLAIM_OUTBOX_QUERY = '''
+    UPDATE outbox SET lease_owner = ?, lease_until = ?, attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE status = 'pending' AND lease_until < ?
+        ORDER BY id
+        LIMIT ?
+    )
+    RETURNING id, day, user_id, namaz_key, namaz_time, notification_offset, computed, attempts
+'''
+USER_MESSAGES_QUERY = 'SELECT message_id FROM messages WHERE user_id = ? AND message_type = ?'
+NEW_USERS_QUERY = "SELECT COUNT(*) as count FROM users WHERE created_at >= datetime('now', ?)"
+# {conflict} - REPLACE (новые данные важнее) или IGNORE (сохраненные дни не трогаем)
+SCHEDULE_INSERT_QUERY = '''
+    INSERT OR {conflict} INTO schedule_cache
+    (city, year, month, day, fajr, sunrise, dhuhr, asr, maghrib, isha)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SCHEDULE_SELECT_QUERY = f'SELECT city, year, month, day, {", ".join(NAMAZ_ORDER)} FROM schedule_cache'
+
+# Запросы, которые не должны выполняться полным сканированием (проверяются при init_db)
+HOT_QUERIES = {
+    'get_subscribed_users': (SUBSCRIBED_USERS_QUERY, ()),
+    'get_old_messages': (OLD_MESSAGES_QUERY, (2,)),
+    'get_old_messages_page': (OLD_MESSAGES_PAGE_QUERY, ('2000-01-01 00:00:00', 1000)),
+    'get_user_messages': (USER_MESSAGES_QUERY, (0, 'notification')),
+    'get_statistics.new_users': (NEW_USERS_QUERY, ('-7 days',)),
+}
+
 class Database:
-    def __init__(self, db_path='namaz_bot.db'):
+    def __init__(self, db_path='namaz_bot.db', readers=3, flush_size=500, flush_interval=1.0,
+                 user_cache_size=10000):
         self.db_path = db_path
+        self.readers_count = readers
+        # LRU-кэш пользователей: user_id -> строка users
+        self.user_cache_size = user_cache_size
+        self._user_cache = OrderedDict()
+        self.user_cache_hits = 0
+        self.user_cache_misses = 0
+        # Отложенная запись message_id: копим записи и сбрасываем одной транзакцией
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._message_buffer = []
+        self._flush_task = None
+        # Будит _flush_loop, когда буфер заполнен, и при закрытии БД
+        self._flush_wakeup = None
+        self._closing = False
+        self._writer_conn = None
+        self._write_lock = asyncio.Lock()
+        self._readers = None
+        self._reader_conns = []
+        self._connect_lock = asyncio.Lock()
+    
+    async def _open_connection(self):
+        conn = await aiosqlite.connect(self.db_path, cached_statements=256)
+        conn.row_factory = aiosqlite.Row
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+    
+    async def connect(self):
+        """Открывает постоянные соединения: одно для записи и несколько для чтения"""
+        async with self._connect_lock:
+            if self._writer_conn is not None:
+                return
+            self._writer_conn = await self._open_connection()
+            self._readers = asyncio.Queue()
+            for _ in range(self.readers_count):
+                conn = await self._open_connection()
+                self._reader_conns.append(conn)
+                self._readers.put_nowait(conn)
+            self._flush_wakeup = asyncio.Event()
+            self._closing = False
+            self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def close(self):
+        """Сбрасывает буфер записи и закрывает все соединения с БД"""
+        if self._flush_task is not None:
+            # Цикл записи завершается сам: отмена посреди записи потеряла бы пачку
+            self._closing = True
+            self._flush_wakeup.set()
+            await self._flush_task
+            self._flush_task = None
+        if self._writer_conn is not None:
+            await self.flush_messages()
+        async with self._connect_lock:
+            for conn in self._reader_conns:
+                await conn.close()
+            self._reader_conns = []
+            self._readers = None
+            if self._writer_conn is not None:
+                await self._writer_conn.close()
+                self._writer_conn = None
+    
+    @asynccontextmanager
+    async def _writer(self):
+        """Соединение для записи (запись в SQLite всегда последовательная)"""
+        if self._writer_conn is None:
+            await self.connect()
+        async with self._write_lock:
+            try:
+                yield self._writer_conn
+            except BaseException:
+                # В том числе отмена задачи (CancelledError): иначе незавершенная
+                # транзакция осталась бы открытой на общем соединении записи
+                await self._writer_conn.rollback()
+                raise
+    
+    @asynccontextmanager
+    async def _reader(self):
+        """Соединение из пула для чтения"""
+        if self._writer_conn is None:
+            await self.connect()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
     
     async def init_db(self):
-        """Инициализирует базу данных"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    subscribed INTEGER DEFAULT 0,
-                    notification_offset INTEGER DEFAULT 10,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS schedule_cache (
-                    month INTEGER,
-                    year INTEGER,
-                    day INTEGER,
-                    fajr TEXT,
-                    sunrise TEXT,
-                    dhuhr TEXT,
-                    asr TEXT,
-                    maghrib TEXT,
-                    isha TEXT,
-                    PRIMARY KEY (year, month, day)
-                )
-            ''')
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id INTEGER,
-                    user_id INTEGER,
-                    message_type TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (message_id, user_id)
-                )
-            ''')
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS pinned_messages (
-                    user_id INTEGER PRIMARY KEY,
-                    message_id INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            await db.commit()
+        """Инициализирует базу данных и применяет недостающие миграции"""
+        async with self._writer() as db:
+            async with db.execute('PRAGMA user_version') as cursor:
+                current_version = (await cursor.fetchone())[0]
+            
+            for version, statements in MIGRATIONS:
+                if version <= current_version:
+                    continue
+                await db.execute('BEGIN')
+                for statement in statements:
+                    # Оператор - строка SQL или (SQL, параметры)
+                    if isinstance(statement, tuple):
+                        await db.execute(*statement)
+                    else:
+                        await db.execute(statement)
+                await db.execute(f'PRAGMA user_version = {version}')
+                await db.commit()
+                print(f"✅ Схема БД обновлена до версии {version}")
+        
+        slow_queries = await self.check_query_plans()
+        if slow_queries:
+            print(f"⚠️ Запросы без индекса: {', '.join(slow_queries)}")
     
+    async def check_query_plans(self):
+        """Возвращает названия горячих запросов, план которых содержит SCAN.
+        
+        SCAN ... USING COVERING INDEX - тоже полный проход, только по индексу,
+        поэтому считается ошибкой (проверяется тестом tests/test_query_plans.py).
+        """
+        slow_queries = []
+        async with self._reader() as db:
+            for name, (query, params) in HOT_QUERIES.items():
+                async with db.execute(f'EXPLAIN QUERY PLAN {query}', params) as cursor:
+                    plan = [row['detail'] for row in await cursor.fetchall()]
+                if any(detail.startswith('SCAN') for detail in plan):
+                    slow_queries.append(name)
+        return slow_queries
+    
+    def _cache_user(self, user):
+        """Кладет пользователя в LRU-кэш, вытесняя самых давних"""
+        self._user_cache[user['user_id']] = user
+        self._user_cache.move_to_end(user['user_id'])
+        while len(self._user_cache) > self.user_cache_size:
+            self._user_cache.popitem(last=False)
+    
+    def _update_cached_user(self, user_id, **fields):
+        """Обновляет пользователя в кэше после записи в БД (write-through)"""
+        user = self._user_cache.get(user_id)
+        if user is not None:
+            user.update(fields)
+    
+    def user_cache_stats(self):
+        """Статистика кэша пользователей"""
+        return {
+            'size': len(self._user_cache),
+            'max_size': self.user_cache_size,
+            'hits': self.user_cache_hits,
+            'misses': self.user_cache_misses
+        }
+    
+    @timed(DB_QUERY_DURATION)
     async def get_user(self, user_id):
         """Получает информацию о пользователе"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        user = self._user_cache.get(user_id)
+        if user is not None:
+            self.user_cache_hits += 1
+            self._user_cache.move_to_end(user_id)
+            return dict(user)
+        
+        self.user_cache_misses += 1
+        async with self._reader() as db:
             async with db.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
+                    self._cache_user(dict(row))
                     return dict(row)
                 return None
     
+    @timed(DB_QUERY_DURATION)
     async def create_user(self, user_id):
-        """Создает нового пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        """Создает нового пользователя (для уже известных пользователей запись в БД не выполняется)"""
+        if await self.get_user(user_id) is not None:
+            return
+        async with self._writer() as db:
             await db.execute(
-                'INSERT OR IGNORE INTO users (user_id, subscribed, notification_offset) VALUES (?, 0, 10)',
-                (user_id,)
+                'INSERT OR IGNORE INTO users (user_id, subscribed, notification_offset, city) VALUES (?, 0, 10, ?)',
+                (user_id, DEFAULT_CITY)
             )
             await db.commit()
+        self._cache_user({
+            'user_id': user_id,
+            'subscribed': 0,
+            'notification_offset': 10,
+            'city': DEFAULT_CITY,
+            'created_at': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        })
     
+    @timed(DB_QUERY_DURATION)
     async def subscribe_user(self, user_id):
         """Подписывает пользователя на уведомления"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._writer() as db:
             await db.execute(
                 'UPDATE users SET subscribed = 1 WHERE user_id = ?',
                 (user_id,)
             )
             await db.commit()
+        self._update_cached_user(user_id, subscribed=1)
     
+    @timed(DB_QUERY_DURATION)
     async def unsubscribe_user(self, user_id):
         """Отписывает пользователя от уведомлений"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._writer() as db:
             await db.execute(
                 'UPDATE users SET subscribed = 0 WHERE user_id = ?',
                 (user_id,)
             )
             await db.commit()
+        self._update_cached_user(user_id, subscribed=0)
     
+    @timed(DB_QUERY_DURATION)
     async def set_notification_offset(self, user_id, offset):
         """Устанавливает время напоминания (в минутах)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._writer() as db:
             await db.execute(
                 'UPDATE users SET notification_offset = ? WHERE user_id = ?',
                 (offset, user_id)
             )
             await db.commit()
+        self._update_cached_user(user_id, notification_offset=offset)
     
+    @timed(DB_QUERY_DURATION)
+    async def set_user_city(self, user_id, city):
+        """Устанавливает город пользователя"""
+        async with self._writer() as db:
+            await db.execute(
+                'UPDATE users SET city = ? WHERE user_id = ?',
+                (city, user_id)
+            )
+            await db.commit()
+        self._update_cached_user(user_id, city=city)
+    
+    @timed(DB_QUERY_DURATION)
     async def get_subscribed_users(self):
         """Получает список всех подписанных пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('SELECT * FROM users WHERE subscribed = 1') as cursor:
+        async with self._reader() as db:
+            async with db.execute(SUBSCRIBED_USERS_QUERY) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
     
-    async def save_schedule(self, schedule, month, year):
-        """Сохраняет расписание в кэш"""
-        async with aiosqlite.connect(self.db_path) as db:
-            for day, times in schedule.items():
-                await db.execute('''
-                    INSERT OR REPLACE INTO schedule_cache 
-                    (year, month, day, fajr, sunrise, dhuhr, asr, maghrib, isha)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (year, month, day, times.get('fajr'), times.get('sunrise'),
-                      times.get('dhuhr'), times.get('asr'), times.get('maghrib'), times.get('isha')))
-            await db.commit()
-    
-    async def get_schedule(self, day, month, year):
-        """Получает расписание из кэша"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+    @timed(DB_QUERY_DURATION)
+    async def save_schedule(self, schedule, month, year, city=DEFAULT_CITY):
+        """Сохраняет расписание города в кэш: {day: расписание дня (day_schedule.pack_day)}"""
+        async with self._writer() as db:
+            await db.executemany(SCHEDULE_INSERT_QUERY.format(conflict='REPLACE'), (
+                _schedule_params(city, year, month, day, times) for day, times in schedule.items()
+            ))
+            await db.commit()
+    
+    @timed(DB_QUERY_DURATION)
+    async def import_schedules(self, schedules, replace=False):
+        """Загружает дни расписания {city: [(date, расписание дня)]} одной транзакцией.
+        
+        Без replace уже сохраненные дни не перезаписываются (расписание с сайта
+        новее снимка). Возвращает количество записанных дней.
+        """
+        async with self._writer() as db:
+            cursor = await db.executemany(
+                SCHEDULE_INSERT_QUERY.format(conflict='REPLACE' if replace else 'IGNORE'),
+                (
+                    _schedule_params(city, date.year, date.month, date.day, times)
+                    for city, days in schedules.items()
+                    for date, times in days
+                )
+            )
+            await db.commit()
+            return cursor.rowcount
+    
+    @timed(DB_QUERY_DURATION)
+    async def get_all_schedules(self):
+        """Все сохраненные дни расписания: {city: [(date, расписание дня)]} по возрастанию даты"""
+        schedules = {}
+        async with self._reader() as db:
+            async with db.execute(f'{SCHEDULE_SELECT_QUERY} ORDER BY city, year, month, day') as cursor:
+                for row in await cursor.fetchall():
+                    schedules.setdefault(row['city'], []).append(_schedule_row(row))
+        return schedules
+    
+    @timed(DB_QUERY_DURATION)
+    async def get_cached_schedules(self, city=DEFAULT_CITY):
+        """Все сохраненные дни расписания города: [(date, расписание дня)] по возрастанию даты"""
+        async with self._reader() as db:
             async with db.execute(
-                'SELECT * FROM schedule_cache WHERE year = ? AND month = ? AND day = ?',
-                (year, month, day)
+                f'{SCHEDULE_SELECT_QUERY} WHERE city = ? ORDER BY year, month, day', (city,)
+            ) as cursor:
+                return [_schedule_row(row) for row in await cursor.fetchall()]
+    
+    @timed(DB_QUERY_DURATION)
+    async def get_schedule(self, day, month, year, city=DEFAULT_CITY):
+        """Получает расписание города из кэша (day_schedule.pack_day) или None"""
+        async with self._reader() as db:
+            async with db.execute(
+                'SELECT * FROM schedule_cache WHERE city = ? AND year = ? AND month = ? AND day = ?',
+                (city, year, month, day)
             ) as cursor:
                 row = await cursor.fetchone()
                 if row:
-                    return {
-                        'fajr': row['fajr'],
-                        'sunrise': row['sunrise'],
-                        'dhuhr': row['dhuhr'],
-                        'asr': row['asr'],
-                        'maghrib': row['maghrib'],
-                        'isha': row['isha']
-                    }
+                    return pack_day([row[namaz_key] for namaz_key in NAMAZ_ORDER])
                 return None
     
+    @timed(DB_QUERY_DURATION)
     async def get_statistics(self):
         """Получает статистику пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            
+        async with self._reader() as db:
             # Общее количество пользователей
             async with db.execute('SELECT COUNT(*) as count FROM users') as cursor:
                 total_users = (await cursor.fetchone())['count']
@@ -149,17 +547,11 @@ class Database:
                 subscribed_users = (await cursor.fetchone())['count']
             
             # Новые пользователи за последние 7 дней
-            async with db.execute('''
-                SELECT COUNT(*) as count FROM users 
-                WHERE created_at >= datetime('now', '-7 days')
-            ''') as cursor:
+            async with db.execute(NEW_USERS_QUERY, ('-7 days',)) as cursor:
                 new_users_week = (await cursor.fetchone())['count']
             
             # Новые пользователи за последние 30 дней
-            async with db.execute('''
-                SELECT COUNT(*) as count FROM users 
-                WHERE created_at >= datetime('now', '-30 days')
-            ''') as cursor:
+            async with db.execute(NEW_USERS_QUERY, ('-30 days',)) as cursor:
                 new_users_month = (await cursor.fetchone())['count']
             
             # Распределение по времени напоминания
@@ -173,76 +565,270 @@ class Database:
                 offset_distribution = {row['notification_offset']: row['count'] 
                                      for row in await cursor.fetchall()}
             
+            # Распределение подписчиков по городам
+            async with db.execute('''
+                SELECT city, COUNT(*) as count
+                FROM users
+                WHERE subscribed = 1
+                GROUP BY city
+            ''') as cursor:
+                city_distribution = {row['city']: row['count'] for row in await cursor.fetchall()}
+            
             return {
                 'total_users': total_users,
                 'subscribed_users': subscribed_users,
                 'unsubscribed_users': total_users - subscribed_users,
                 'new_users_week': new_users_week,
                 'new_users_month': new_users_month,
-                'offset_distribution': offset_distribution
+                'offset_distribution': offset_distribution,
+                'city_distribution': city_distribution
             }
     
+    @timed(DB_QUERY_DURATION)
     async def save_message(self, message_id, user_id, message_type='notification'):
-        """Сохраняет message_id уведомления или другого сообщения"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                'INSERT OR REPLACE INTO messages (message_id, user_id, message_type) VALUES (?, ?, ?)',
-                (message_id, user_id, message_type)
-            )
-            await db.commit()
+        """Сохраняет message_id уведомления или другого сообщения (запись отложенная)"""
+        self._message_buffer.append((message_id, user_id, message_type))
+        if len(self._message_buffer) >= self.flush_size and self._flush_wakeup is not None:
+            self._flush_wakeup.set()
     
+    @timed(DB_QUERY_DURATION)
+    async def flush_messages(self):
+        """Записывает накопленные message_id одной транзакцией"""
+        if not self._message_buffer:
+            return
+        batch, self._message_buffer = self._message_buffer, []
+        try:
+            async with self._writer() as db:
+                await db.executemany(
+                    'INSERT OR REPLACE INTO messages (message_id, user_id, message_type) VALUES (?, ?, ?)',
+                    batch
+                )
+                await db.commit()
+        except Exception:
+            # Возвращаем записи в буфер, чтобы не потерять их при следующей попытке
+            self._message_buffer[:0] = batch
+            raise
+    
+    async def _flush_loop(self):
+        """Сбрасывает буфер message_id на диск раз в flush_interval или сразу, если буфер заполнен"""
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            try:
+                await self.flush_messages()
+            except Exception as e:
+                print(f"❌ Ошибка записи сообщений в БД: {e}")
+    
+    @timed(DB_QUERY_DURATION)
     async def get_old_messages(self, days=2):
         """Получает список старых сообщений (старше указанного количества дней)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('''
-                SELECT message_id, user_id FROM messages 
-                WHERE created_at < datetime('now', '-' || ? || ' days')
-                AND message_type = 'notification'
-            ''', (days,)) as cursor:
+        await self.flush_messages()
+        async with self._reader() as db:
+            async with db.execute(OLD_MESSAGES_QUERY, (days,)) as cursor:
                 rows = await cursor.fetchall()
                 return [(row['message_id'], row['user_id']) for row in rows]
     
+    @timed(DB_QUERY_DURATION)
+    async def get_old_messages_page(self, cutoff, limit):
+        """Получает не больше limit уведомлений, созданных раньше cutoff (строка UTC), самые старые первыми"""
+        await self.flush_messages()
+        async with self._reader() as db:
+            async with db.execute(OLD_MESSAGES_PAGE_QUERY, (cutoff, limit)) as cursor:
+                rows = await cursor.fetchall()
+                return [(row['message_id'], row['user_id']) for row in rows]
+    
+    @timed(DB_QUERY_DURATION)
     async def delete_messages(self, message_ids_with_users):
         """Удаляет сообщения из БД"""
         if not message_ids_with_users:
             return
-        async with aiosqlite.connect(self.db_path) as db:
-            for message_id, user_id in message_ids_with_users:
+        await self.flush_messages()
+        pairs = list(message_ids_with_users)
+        async with self._writer() as db:
+            # Удаляем пачками по DELETE_CHUNK пар, чтобы не превысить лимит параметров SQLite
+            for start in range(0, len(pairs), DELETE_CHUNK):
+                chunk = pairs[start:start + DELETE_CHUNK]
+                placeholders = ', '.join(['(?, ?)'] * len(chunk))
+                params = [value for pair in chunk for value in pair]
                 await db.execute(
-                    'DELETE FROM messages WHERE message_id = ? AND user_id = ?',
-                    (message_id, user_id)
+                    f'DELETE FROM messages WHERE (message_id, user_id) IN (VALUES {placeholders})',
+                    params
                 )
             await db.commit()
     
+    @timed(DB_QUERY_DURATION)
     async def get_user_messages(self, user_id, message_type='notification'):
         """Получает все сообщения пользователя определенного типа"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                'SELECT message_id FROM messages WHERE user_id = ? AND message_type = ?',
-                (user_id, message_type)
-            ) as cursor:
+        await self.flush_messages()
+        async with self._reader() as db:
+            async with db.execute(USER_MESSAGES_QUERY, (user_id, message_type)) as cursor:
                 rows = await cursor.fetchall()
                 return [row['message_id'] for row in rows]
     
+    @timed(DB_QUERY_DURATION)
     async def save_pinned_message(self, user_id, message_id):
         """Сохраняет message_id закрепленного сообщения"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._writer() as db:
             await db.execute(
                 'INSERT OR REPLACE INTO pinned_messages (user_id, message_id) VALUES (?, ?)',
                 (user_id, message_id)
             )
             await db.commit()
     
+    @timed(DB_QUERY_DURATION)
     async def get_pinned_message(self, user_id):
         """Получает message_id закрепленного сообщения пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self._reader() as db:
             async with db.execute(
                 'SELECT message_id FROM pinned_messages WHERE user_id = ?',
                 (user_id,)
             ) as cursor:
                 row = await cursor.fetchone()
                 return row['message_id'] if row else None
-
+    
+    @timed(DB_QUERY_DURATION)
+    async def get_cleanup_progress(self, name):
+        """Получает прогресс незавершенной очистки или None"""
+        async with self._reader() as db:
+            async with db.execute(
+                'SELECT cutoff, deleted, failed, started_at FROM cleanup_progress WHERE name = ?',
+                (name,)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+    
+    @timed(DB_QUERY_DURATION)
+    async def save_cleanup_progress(self, name, cutoff, deleted, failed):
+        """Сохраняет прогресс очистки"""
+        async with self._writer() as db:
+            await db.execute(
+                '''
+                INSERT INTO cleanup_progress (name, cutoff, deleted, failed) VALUES (?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET cutoff = excluded.cutoff,
+                    deleted = excluded.deleted, failed = excluded.failed
+                ''',
+                (name, cutoff, deleted, failed)
+            )
+            await db.commit()
+    
+    @timed(DB_QUERY_DURATION)
+    async def clear_cleanup_progress(self, name):
+        """Отмечает очистку как завершенную"""
+        async with self._writer() as db:
+            await db.execute('DELETE FROM cleanup_progress WHERE name = ?', (name,))
+            await db.commit()
+    
+    @timed(DB_QUERY_DURATION)
+    async def enqueue_outbox(self, day, entries):
+        """Ставит напоминания в очередь и отмечает их в журнале отправки одной транзакцией.
+        
+        entries - список (user_id, namaz_key, namaz_time, offset, computed). Пользователи,
+        которые уже отписались (в том числе отключенные процессом рассылки после
+        блокировки бота), в очередь не попадают.
+        """
+        if not entries:
+            return
+        async with self._writer() as db:
+            await db.executemany(
+                '''
+                INSERT OR IGNORE INTO deliveries (day, user_id, namaz_key)
+                SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ? AND subscribed = 1)
+                ''',
+                [(day, user_id, namaz_key, user_id) for user_id, namaz_key, *_ in entries]
+            )
+            await db.executemany(
+                '''
+                INSERT OR IGNORE INTO outbox (day, user_id, namaz_key, namaz_time, notification_offset, computed)
+                SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE user_id = ? AND subscribed = 1)
+                ''',
+                [(day, *entry[:4], int(entry[4]), entry[0]) for entry in entries]
+            )
+            await db.commit()
+    
+    @timed(DB_QUERY_DURATION)
+    async def claim_outbox(self, worker, limit, lease_seconds):
+        """Захватывает до limit задач очереди на lease_seconds секунд.
+        
+        Задачи, аренда которых истекла (процесс рассылки упал), захватываются повторно.
+        """
+        now = time.time()
+        async with self._writer() as db:
+            async with db.execute(CLAIM_OUTBOX_QUERY, (worker, now + lease_seconds, now, limit)) as cursor:
+                rows = await cursor.fetchall()
+            await db.commit()
+            return [dict(row) for row in rows]
+    
+    @timed(DB_QUERY_DURATION)
+    async def finish_outbox(self, worker, results):
+        """Подтверждает обработку пачки задач одной транзакцией.
+        
+        results - список (job_id, status): done - доставлено, failed - доставка невозможна,
+        expired - время намаза прошло до отправки
+        """
+        if not results:
+            return
+        async with self._writer() as db:
+            await db.executemany(
+                'UPDATE outbox SET status = ? WHERE id = ? AND lease_owner = ?',
+                [(status, job_id, worker) for job_id, status in results]
+            )
+            await db.commit()
+    
+    @timed(DB_QUERY_DURATION)
+    async def take_blocked_outbox(self):
+        """Пользователи из задач со статусом blocked (заблокировали бота); задачи переводятся в failed"""
+        async with self._writer() as db:
+            async with db.execute(
+                "UPDATE outbox SET status = 'failed' WHERE status = 'blocked' RETURNING user_id"
+            ) as cursor:
+                rows = await cursor.fetchall()
+            await db.commit()
+            return {row['user_id'] for row in rows}
+    
+    @timed(DB_QUERY_DURATION)
+    async def get_outbox_stats(self):
+        """Количество задач очереди по статусам"""
+        async with self._reader() as db:
+            async with db.execute('SELECT status, COUNT(*) AS count FROM outbox GROUP BY status') as cursor:
+                return {row['status']: row['count'] for row in await cursor.fetchall()}
+    
+    @timed(DB_QUERY_DURATION)
+    async def prune_outbox(self, before_day):
+        """Удаляет задачи очереди за дни раньше указанного"""
+        async with self._writer() as db:
+            cursor = await db.execute('DELETE FROM outbox WHERE day < ?', (before_day,))
+            await db.commit()
+            return cursor.rowcount
+    
+    @timed(DB_QUERY_DURATION)
+    async def get_deliveries(self, day):
+        """Получает отправленные за день напоминания (day в формате YYYYMMDD)"""
+        async with self._reader() as db:
+            async with db.execute(
+                'SELECT user_id, namaz_key FROM deliveries WHERE day = ?',
+                (day,)
+            ) as cursor:
+                return [(row['user_id'], row['namaz_key']) for row in await cursor.fetchall()]
+    
+    @timed(DB_QUERY_DURATION)
+    async def save_deliveries(self, day, entries):
+        """Отмечает напоминания как отправленные. entries - список (user_id, namaz_key)"""
+        if not entries:
+            return
+        async with self._writer() as db:
+            await db.executemany(
+                'INSERT OR IGNORE INTO deliveries (day, user_id, namaz_key) VALUES (?, ?, ?)',
+                [(day, user_id, namaz_key) for user_id, namaz_key in entries]
+            )
+            await db.commit()
+    
+    @timed(DB_QUERY_DURATION)
+    async def prune_deliveries(self, before_day):
+        """Удаляет записи об отправке за дни раньше указанного"""
+        async with self._writer() as db:
+            cursor = await db.execute('DELETE FROM deliveries WHERE day < ?', (before_day,))
+            await db.commit()
+            return cursor.rowcount
@@ -0,0 +1,69 @@
+"""Компактное расписание дня: минуты от полуночи вместо строк 'HH:MM'.
+
+Расписание дня - array('h') длиной len(NAMAZ_ORDER), времена в порядке
+NAMAZ_ORDER, MISSING - времени нет. В таком виде расписание хранится в БД,
+в памяти и в индексе планировщика; строки получаются только при выводе.
+"""
+from array import array
+from datetime import datetime
+
+from config import NAMAZ_ORDER, TIMEZONE
+
+MISSING = -1
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_minutes(value):
+    """Минуты от полуночи из '06:53', '6.53' или числа; MISSING, если время не распознано"""
+    if value is None:
+        return MISSING
+    if isinstance(value, int):
+        return value if 0 <= value < MINUTES_PER_DAY else MISSING
+    value = value.replace(' ', '').replace('.', ':')
+    hours, sep, minutes = value.partition(':')
+    if not sep or not hours.isdigit() or not minutes.isdigit():
+        return MISSING
+    total = int(hours) * 60 + int(minutes)
+    return total if int(minutes) < 60 and total < MINUTES_PER_DAY else MISSING
+
+
+def pack_day(times):
+    """Расписание дня из {namaz_key: время} или последовательности времен в порядке NAMAZ_ORDER"""
+    if isinstance(times, dict):
+        times = [times.get(namaz_key) for namaz_key in NAMAZ_ORDER]
+    return array('h', (parse_minutes(value) for value in times))
+
+
+def format_minutes(minutes):
+    """'HH:MM' для минут от полуночи или None для MISSING"""
+    if minutes == MISSING:
+        return None
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def has_times(day):
+    """Есть ли в расписании дня хотя бы одно время"""
+    return day is not None and any(minutes != MISSING for minutes in day)
+
+
+def day_times(day):
+    """{namaz_key: 'HH:MM'} для вывода пользователю, только известные времена"""
+    return {
+        namaz_key: format_minutes(minutes)
+        for namaz_key, minutes in zip(NAMAZ_ORDER, day)
+        if minutes != MISSING
+    }
+
+
+def day_epochs(date, day):
+    """Время каждого намаза даты в секундах unix (UTC) или None для MISSING.
+
+    Переход на летнее время учитывается, поэтому время считается через
+    часовой пояс, а не сдвигом от полуночи.
+    """
+    return [
+        None if minutes == MISSING else int(TIMEZONE.localize(
+            datetime(date.year, date.month, date.day, minutes // 60, minutes % 60)
+        ).timestamp())
+        for minutes in day
+    ]
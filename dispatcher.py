@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from config import DISPATCH_CONCURRENCY, DISPATCH_RATE, DISPATCH_CHAT_INTERVAL, DISPATCH_MAX_RETRIES
+from metrics import SENDS, SEND_LATENCY, FANOUT_DURATION, FANOUT_LAST_FINISHED
+
+logger = logging.getLogger(__name__)
+
+# Максимум сообщений в одном запросе deleteMessages (Bot API 7.0)
+BULK_DELETE_LIMIT = 100
+
+
+class TokenBucket:
+    """Глобальный ограничитель скорости отправки (token bucket)"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Приостанавливает выдачу токенов (flood control со стороны Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Ждет, пока не появится свободный токен"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class NotificationDispatcher:
+    """Рассылка сообщений с ограничением параллельности и скорости"""
+
+    def __init__(self, bot, rate=DISPATCH_RATE, concurrency=DISPATCH_CONCURRENCY,
+                 chat_interval=DISPATCH_CHAT_INTERVAL, max_retries=DISPATCH_MAX_RETRIES,
+                 on_blocked=None):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.chat_interval = chat_interval
+        self.max_retries = max_retries
+        self.on_blocked = on_blocked
+        self._bucket = TokenBucket(rate)
+        self._chat_next = {}
+        self.last_batch_stats = None
+        self.counters = {'sent': 0, 'failed': 0, 'rate_limited': 0, 'blocked': 0, 'retried': 0, 'deleted': 0}
+
+    def _count(self, result):
+        self.counters[result] += 1
+        SENDS.inc(result=result)
+
+    async def _wait_chat(self, chat_id):
+        """Соблюдает лимит отправки в один чат"""
+        now = time.monotonic()
+        next_time = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, next_time) + self.chat_interval
+        if next_time > now:
+            await asyncio.sleep(next_time - now)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        """Отправляет сообщение с повторами. Возвращает Message или None, если доставка невозможна"""
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            await self._wait_chat(chat_id)
+            await self._bucket.acquire()
+            try:
+                started = time.perf_counter()
+                message = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                SEND_LATENCY.observe(time.perf_counter() - started)
+                self._count('sent')
+                return message
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self._count('rate_limited')
+                # Ограничение действует на весь бот, поэтому останавливаем общий поток
+                self._bucket.pause(retry_after)
+                logger.warning(f"Flood control: пауза {retry_after} с")
+            except Forbidden as e:
+                # Пользователь заблокировал бота
+                self._count('blocked')
+                await self._handle_blocked(chat_id, e)
+                return None
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    self._count('blocked')
+                    await self._handle_blocked(chat_id, e)
+                else:
+                    self._count('failed')
+                    logger.error(f"Ошибка отправки пользователю {chat_id}: {e}")
+                return None
+            except (TimedOut, NetworkError) as e:
+                last_error = e
+                if attempt == self.max_retries:
+                    break
+                self._count('retried')
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+        self._count('failed')
+        logger.error(
+            f"Не удалось отправить сообщение пользователю {chat_id} после {self.max_retries + 1} попыток: {last_error or 'flood control'}"
+        )
+        return None
+
+    async def delete_messages(self, chat_id, message_ids):
+        """Удаляет сообщения из чата с учетом общего лимита скорости. Возвращает число удаленных.
+
+        Если библиотека поддерживает deleteMessages, сообщения удаляются пачками
+        по BULK_DELETE_LIMIT за один запрос, иначе - по одному.
+        """
+        bulk_delete = getattr(self.bot, 'delete_messages', None)
+        if bulk_delete is not None:
+            chunks = [message_ids[i:i + BULK_DELETE_LIMIT] for i in range(0, len(message_ids), BULK_DELETE_LIMIT)]
+            call = lambda chunk: bulk_delete(chat_id=chat_id, message_ids=chunk)
+        else:
+            chunks = [[message_id] for message_id in message_ids]
+            call = lambda chunk: self.bot.delete_message(chat_id=chat_id, message_id=chunk[0])
+
+        deleted = 0
+        for chunk in chunks:
+            if await self._delete_chunk(call, chat_id, chunk):
+                deleted += len(chunk)
+        self.counters['deleted'] += deleted
+        return deleted
+
+    async def _delete_chunk(self, call, chat_id, chunk):
+        for attempt in range(self.max_retries + 1):
+            await self._bucket.acquire()
+            try:
+                await call(chunk)
+                return True
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                self.counters['rate_limited'] += 1
+                self._bucket.pause(retry_after)
+                logger.warning(f"Flood control: пауза {retry_after} с")
+            except (Forbidden, BadRequest) as e:
+                # Сообщение уже удалено, слишком старое или чат недоступен
+                logger.debug(f"Не удалось удалить сообщения {chunk} в чате {chat_id}: {e}")
+                return False
+            except (TimedOut, NetworkError):
+                if attempt == self.max_retries:
+                    break
+                self.counters['retried'] += 1
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        logger.debug(f"Не удалось удалить сообщения {chunk} в чате {chat_id} после {self.max_retries + 1} попыток")
+        return False
+
+    async def _handle_blocked(self, chat_id, error):
+        logger.info(f"Пользователь {chat_id} недоступен ({error}), отключаем рассылку")
+        if self.on_blocked:
+            try:
+                await self.on_blocked(chat_id)
+            except Exception as e:
+                logger.error(f"Ошибка отключения пользователя {chat_id}: {e}")
+
+    async def run_batch(self, jobs, label='batch'):
+        """Выполняет пачку корутин-фабрик с ограниченной параллельностью и печатает статистику.
+
+        Каждый элемент jobs - вызываемый объект без аргументов, возвращающий корутину,
+        результат которой (True/False) означает успех доставки.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return None
+
+        started = time.monotonic()
+        latencies = []
+        ok = 0
+        iterator = iter(jobs)
+
+        async def worker():
+            nonlocal ok
+            for job in iterator:
+                try:
+                    if await job():
+                        ok += 1
+                except Exception as e:
+                    logger.error(f"Ошибка задачи рассылки ({label}): {e}")
+                latencies.append(time.monotonic() - started)
+
+        workers = min(self.concurrency, len(jobs))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+        elapsed = time.monotonic() - started
+        latencies.sort()
+        stats = {
+            'label': label,
+            'total': len(jobs),
+            'ok': ok,
+            'elapsed': elapsed,
+            'throughput': len(jobs) / elapsed if elapsed > 0 else float(len(jobs)),
+            'p50': _percentile(latencies, 0.50),
+            'p95': _percentile(latencies, 0.95),
+            'p99': _percentile(latencies, 0.99),
+            'max': latencies[-1],
+        }
+        self.last_batch_stats = stats
+        FANOUT_DURATION.observe(elapsed)
+        FANOUT_LAST_FINISHED.set(time.time())
+
+        # Лимиты по чатам нужны только в пределах пачки
+        now = time.monotonic()
+        self._chat_next = {chat_id: t for chat_id, t in self._chat_next.items() if t > now}
+
+        print(
+            f"📨 Рассылка {label}: {ok}/{len(jobs)} за {elapsed:.1f} с "
+            f"({stats['throughput']:.1f} сообщ./с, p95 {stats['p95']:.1f} с, p99 {stats['p99']:.1f} с)"
+        )
+        return stats
+
+
+def format_reminder(namaz_name, namaz_time, offset, computed=False):
+    """Текст напоминания; computed - время рассчитано по координатам города, а не взято с сайта"""
+    message = f"🕌 Через {offset} минут намаз {namaz_name} в {namaz_time}"
+    if computed:
+        message += "\nℹ️ Расписание еще не опубликовано, время рассчитано по координатам города"
+    return message
+
+
+async def send_reminder(dispatcher, db, user_id, namaz_name, namaz_time, offset, computed=False):
+    """Отправляет напоминание и сохраняет его message_id для автоочистки.
+
+    Используется и процессом бота, и процессами рассылки outbox_worker.py.
+    Возвращает True при успешной доставке.
+    """
+    try:
+        sent_message = await dispatcher.send_message(
+            user_id, format_reminder(namaz_name, namaz_time, offset, computed)
+        )
+        if not sent_message:
+            return False
+        await db.save_message(sent_message.message_id, user_id, 'notification')
+        return True
+    except Exception as e:
+        print(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
+        return False
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
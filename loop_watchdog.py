@@ -0,0 +1,150 @@
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from config import WATCHDOG_INTERVAL, WATCHDOG_THRESHOLD
+from metrics import LOOP_LAG, LOOP_STALLS
+
+# Файлы проекта: виновником блокировки считается самый глубокий кадр из них
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Сколько последних замеров задержки хранить для перцентилей
+LAG_WINDOW = 3000
+
+# Сколько кадров стека показывать для каждого виновника
+STACK_DEPTH = 8
+
+
+class LoopWatchdog:
+    """Следит за задержкой event loop и находит код, который его блокирует.
+
+    Корутина в event loop раз в interval секунд обновляет метку времени и измеряет,
+    насколько позже запланированного она проснулась. Отдельный поток проверяет метку
+    и, если loop не отвечает дольше threshold секунд, снимает стек потока loop.
+    """
+
+    def __init__(self, interval=WATCHDOG_INTERVAL, threshold=WATCHDOG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self._lags = deque(maxlen=LAG_WINDOW)
+        # Виновники: место в коде -> {'count', 'max_lag', 'total_lag', 'stack'}
+        self.offenders = {}
+        self.stalls = 0
+        self._heartbeat = time.monotonic()
+        self._pending = None
+        self._lock = threading.Lock()
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._loop_thread_id = None
+
+    def start(self):
+        """Запускает наблюдение (вызывается из работающего event loop)"""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat_loop())
+        self._thread = threading.Thread(target=self._monitor, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _heartbeat_loop(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self._lags.append(lag)
+            LOOP_LAG.observe(lag)
+            with self._lock:
+                self._heartbeat = now
+                pending, self._pending = self._pending, None
+            if pending is not None and lag >= self.threshold:
+                self._record(pending, lag)
+
+    def _monitor(self):
+        """Поток-наблюдатель: снимает стек loop, пока тот заблокирован"""
+        while not self._stop.wait(self.threshold / 2):
+            with self._lock:
+                heartbeat = self._heartbeat
+                if self._pending is not None:
+                    continue
+            if time.monotonic() - heartbeat - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            # Стек снимается один раз за блокировку - в момент ее обнаружения.
+            # extract_stack читает исходники с диска, поэтому под блокировкой его
+            # не вызываем: иначе heartbeat loop ждал бы этот поток
+            stack = traceback.extract_stack(frame)
+            del frame
+            with self._lock:
+                # Loop успел ожить - стек относится к уже закончившейся блокировке
+                if self._heartbeat == heartbeat and self._pending is None:
+                    self._pending = stack
+
+    def _record(self, stack, lag):
+        location, lines = _describe_stack(stack)
+        self.stalls += 1
+        LOOP_STALLS.inc()
+        offender = self.offenders.get(location)
+        if offender is None:
+            offender = self.offenders[location] = {'count': 0, 'max_lag': 0.0, 'total_lag': 0.0, 'stack': lines}
+        offender['count'] += 1
+        offender['total_lag'] += lag
+        if lag > offender['max_lag']:
+            offender['max_lag'] = lag
+            offender['stack'] = lines
+        print(f"⚠️ Event loop заблокирован на {lag:.2f} с: {location}")
+
+    def stats(self, top=5):
+        """Перцентили задержки и самые частые места блокировки"""
+        lags = sorted(self._lags)
+        if len(lags) >= 2:
+            cuts = statistics.quantiles(lags, n=100, method='inclusive')
+            p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+        else:
+            p50 = p95 = p99 = lags[0] if lags else 0.0
+        offenders = sorted(self.offenders.items(), key=lambda item: item[1]['total_lag'], reverse=True)
+        return {
+            'samples': len(lags),
+            'p50': p50,
+            'p95': p95,
+            'p99': p99,
+            'max': lags[-1] if lags else 0.0,
+            'stalls': self.stalls,
+            'threshold': self.threshold,
+            'offenders': [dict(offender, location=location) for location, offender in offenders[:top]],
+        }
+
+
+def _describe_stack(stack):
+    """Место блокировки (самый глубокий кадр кода проекта) и последние кадры стека"""
+    location_frame = stack[-1]
+    for frame in reversed(stack):
+        if frame.filename.startswith(PROJECT_DIR):
+            location_frame = frame
+            break
+    location = f"{os.path.basename(location_frame.filename)}:{location_frame.lineno} {location_frame.name}"
+    lines = [
+        f"{os.path.basename(frame.filename)}:{frame.lineno} {frame.name}"
+        for frame in stack[-STACK_DEPTH:]
+    ]
+    return location, lines
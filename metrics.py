@@ -0,0 +1,274 @@
+"""Метрики бота в текстовом формате Prometheus.
+
+Счетчики, gauge и гистограммы регистрируются при импорте модуля, значения
+отдаются HTTP-сервером на /metrics, который работает в event loop бота.
+"""
+import asyncio
+import functools
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, labelnames=(), registry=None):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        """Строки значений метрики в формате Prometheus"""
+        return [f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+                for key, value in sorted(self._values.items())]
+
+    def render(self):
+        return '\n'.join([
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.type_name}",
+        ] + self.samples())
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """Текущее значение. Можно задать функцию, которая вызывается при каждом чтении метрик"""
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), registry=None):
+        super().__init__(name, help_text, labelnames, registry)
+        self._function = None
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """function() возвращает значение (без меток) или словарь {значение метки: значение}"""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception as e:
+                logger.error(f"Ошибка вычисления метрики {self.name}: {e}")
+                return []
+            if isinstance(value, dict):
+                self._values = {(str(label),): v for label, v in value.items()}
+            else:
+                self._values = {(): value}
+        return super().samples()
+
+
+class Histogram(Metric):
+    """Распределение значений по корзинам (обычно длительность в секундах)"""
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, help_text, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [счетчики по корзинам..., +Inf], сумма
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts = state[0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        else:
+            counts[-1] += 1
+        state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Измеряет длительность блока with"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        lines = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else _format_value(bound)
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def timed(histogram, **labels):
+    """Декоратор корутины: длительность вызова записывается в histogram.
+
+    Если у гистограммы есть метка method и она не задана, подставляется имя функции.
+    """
+    def decorator(func):
+        func_labels = dict(labels)
+        if 'method' in histogram.labelnames and 'method' not in func_labels:
+            func_labels['method'] = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**func_labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+# Метрики бота
+
+TICK_DURATION = Histogram(
+    'namaz_tick_duration_seconds', 'Длительность проверки времени намазов (без рассылки)',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+FANOUT_DURATION = Histogram(
+    'namaz_fanout_duration_seconds', 'Длительность рассылки одной пачки напоминаний'
+)
+FANOUT_LAST_FINISHED = Gauge(
+    'namaz_fanout_last_finished_timestamp_seconds', 'Время окончания последней рассылки (unix)'
+)
+SENDS = Counter(
+    'namaz_sends_total', 'Результаты отправки сообщений', ['result']
+)
+SEND_LATENCY = Histogram(
+    'namaz_send_latency_seconds', 'Длительность запроса sendMessage к Telegram',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+FETCH_ATTEMPTS = Counter(
+    'namaz_fetch_attempts_total', 'Запросы расписания к сайту', ['result']
+)
+FETCH_DURATION = Histogram(
+    'namaz_fetch_duration_seconds', 'Длительность загрузки и разбора страницы расписания'
+)
+SCHEDULE_LOOKUPS = Counter(
+    'namaz_schedule_lookups_total', 'Откуда получено расписание на день', ['source']
+)
+DB_QUERY_DURATION = Histogram(
+    'namaz_db_query_duration_seconds', 'Длительность методов Database', ['method'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+)
+HANDLER_DURATION = Histogram(
+    'namaz_handler_duration_seconds', 'Длительность обработки нажатий кнопок', ['callback_data'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+SUBSCRIBERS = Gauge(
+    'namaz_subscribers', 'Подписчики в индексе планировщика'
+)
+BREAKER_OPEN = Gauge(
+    'namaz_fetch_breaker_open', 'Запросы к сайту приостановлены предохранителем (1 - да)', ['host']
+)
+LOOP_LAG = Histogram(
+    'namaz_event_loop_lag_seconds', 'Задержка пробуждения корутин в event loop',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+LOOP_STALLS = Counter(
+    'namaz_event_loop_stalls_total', 'Блокировки event loop дольше порога'
+)
+
+
+async def _handle_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Заголовки запроса не нужны, но их нужно дочитать
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', REGISTRY.render().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            status, body, content_type = '404 Not Found', b'Not Found\n', 'text/plain'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port):
+    """Запускает HTTP-сервер метрик в текущем event loop"""
+    server = await asyncio.start_server(_handle_request, host, port)
+    print(f"📈 Метрики доступны на http://{host}:{port}/metrics")
+    return server
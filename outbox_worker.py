@@ -0,0 +1,188 @@
+"""Процессы рассылки напоминаний из очереди outbox (DISPATCH_MODE=outbox).
+
+Запуск (рядом с ботом, с той же БД):
+    python outbox_worker.py [--workers N]
+
+Планировщик бота записывает напоминания в таблицу outbox. Каждый процесс
+захватывает пачку задач в аренду на OUTBOX_LEASE секунд, отправляет их и
+подтверждает всю пачку одной транзакцией. Если процесс упал, аренда его задач
+истекает и их забирают другие процессы; уже подтвержденные задачи повторно не
+отправляются. Задача, захваченная больше OUTBOX_MAX_ATTEMPTS раз,
+помечается ошибкой, а напоминание, время намаза которого уже прошло, -
+просроченным (expired) без отправки. Задачи пользователей, заблокировавших
+бота, получают статус blocked: отписывает их процесс бота, чтобы обновить
+свой кэш пользователей и индекс напоминаний.
+"""
+import argparse
+import asyncio
+import functools
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from datetime import datetime
+
+from telegram import Bot
+
+from config import (
+    BOT_TOKEN, NAMAZ_NAMES, DISPATCH_RATE, TIMEZONE,
+    OUTBOX_WORKERS, OUTBOX_BATCH, OUTBOX_LEASE, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS
+)
+from database import Database
+from day_schedule import parse_minutes
+from dispatcher import NotificationDispatcher, send_reminder
+
+
+class OutboxWorker:
+    """Забирает задачи из очереди и отправляет их через dispatcher.send_reminder"""
+
+    def __init__(self, bot, db, worker_id, rate, batch_size=OUTBOX_BATCH, lease=OUTBOX_LEASE,
+                 poll_interval=OUTBOX_POLL_INTERVAL, max_attempts=OUTBOX_MAX_ATTEMPTS):
+        self.db = db
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        # Отправка и запись message_id - как в процессе бота (планировщик здесь не нужен)
+        self.dispatcher = NotificationDispatcher(bot, rate=rate, on_blocked=self._mark_blocked)
+        # Пользователи текущей пачки, заблокировавшие бота
+        self._blocked = set()
+        self._stopping = False
+
+    def stop(self):
+        """Завершает работу после текущей пачки"""
+        self._stopping = True
+
+    async def run_once(self):
+        """Обрабатывает одну пачку задач. Возвращает количество захваченных задач"""
+        jobs = await self.db.claim_outbox(self.worker_id, self.batch_size, self.lease)
+        if jobs:
+            # Итоги отправки подтверждаются одной транзакцией на пачку, а не коммитом на сообщение
+            results = []
+            self._blocked = set()
+            try:
+                await self.dispatcher.run_batch(
+                    [functools.partial(self._deliver, job, results) for job in jobs],
+                    label=f"outbox {self.worker_id}"
+                )
+            finally:
+                await self.db.finish_outbox(self.worker_id, results)
+        return len(jobs)
+
+    async def _deliver(self, job, results):
+        if job['attempts'] > self.max_attempts:
+            # Задачу уже захватывали, но не подтвердили (например, ошибка записи в БД
+            # после отправки) - не отправляем ее бесконечно
+            results.append((job['id'], 'failed'))
+            return False
+        if _namaz_timestamp(job) <= time.time():
+            # Процессы рассылки не работали до времени намаза - напоминание уже не нужно
+            results.append((job['id'], 'expired'))
+            return False
+        delivered = await send_reminder(
+            self.dispatcher,
+            self.db,
+            job['user_id'],
+            NAMAZ_NAMES[job['namaz_key']],
+            job['namaz_time'],
+            job['notification_offset'],
+            bool(job['computed'])
+        )
+        if delivered:
+            results.append((job['id'], 'done'))
+        else:
+            results.append((job['id'], 'blocked' if job['user_id'] in self._blocked else 'failed'))
+        return delivered
+
+    async def _mark_blocked(self, user_id):
+        """Запоминает пользователя, заблокировавшего бота (отписывает его процесс бота)"""
+        self._blocked.add(user_id)
+
+    async def run(self):
+        while not self._stopping:
+            try:
+                if await self.run_once():
+                    continue
+            except Exception as e:
+                print(f"❌ Ошибка обработки очереди ({self.worker_id}): {e}")
+            await asyncio.sleep(self.poll_interval)
+
+
+def _namaz_timestamp(job):
+    """Время намаза задачи в секундах unix (day - YYYYMMDD, namaz_time - 'HH:MM')"""
+    day = job['day']
+    minutes = parse_minutes(job['namaz_time'])
+    return TIMEZONE.localize(
+        datetime(day // 10000, day // 100 % 100, day % 100, minutes // 60, minutes % 60)
+    ).timestamp()
+
+
+async def _run_worker(rate):
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    db = Database()
+    await db.connect()
+    loop = asyncio.get_running_loop()
+    try:
+        async with Bot(BOT_TOKEN) as bot:
+            worker = OutboxWorker(bot, db, worker_id, rate)
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, worker.stop)
+            print(f"🚚 Процесс рассылки {worker_id} запущен ({rate:.1f} сообщ./с)")
+            await worker.run()
+    finally:
+        await db.close()
+    print(f"🚚 Процесс рассылки {worker_id} остановлен")
+
+
+def worker_main(rate):
+    asyncio.run(_run_worker(rate))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Процессы рассылки напоминаний из очереди")
+    arg_parser.add_argument('--workers', type=int, default=OUTBOX_WORKERS)
+    args = arg_parser.parse_args()
+    if args.workers < 1:
+        arg_parser.error("--workers должно быть не меньше 1")
+
+    if not BOT_TOKEN:
+        print("❌ BOT_TOKEN не установлен! Проверьте файл .env")
+        sys.exit(1)
+
+    # Лимит Telegram общий для бота, поэтому делится между процессами
+    rate = DISPATCH_RATE / args.workers
+    context = multiprocessing.get_context('spawn')
+    processes = {}
+
+    def spawn(index):
+        process = context.Process(target=worker_main, args=(rate,), name=f"outbox-{index}")
+        process.start()
+        processes[index] = process
+
+    # SIGTERM (docker stop) завершает и дочерние процессы через finally
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    for index in range(args.workers):
+        spawn(index)
+    try:
+        while True:
+            time.sleep(5)
+            for index, process in list(processes.items()):
+                if not process.is_alive():
+                    print(f"⚠️ Процесс {process.name} завершился (код {process.exitcode}), перезапускаем")
+                    spawn(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,147 +1,362 @@
-import requests
+import asyncio
+import re
+import time
+from collections import namedtuple
+import httpx
 from bs4 import BeautifulSoup
-from datetime import datetime, timedelta
-from config import TIMEZONE
+from datetime import datetime
+from urllib.parse import urlsplit
+from config import TIMEZONE, PARSER_BACKEND, FETCH_PER_HOST
+from circuit_breaker import CircuitBreaker
+from metrics import FETCH_ATTEMPTS, FETCH_DURATION, SCHEDULE_LOOKUPS
+from day_schedule import pack_day
+
+try:
+    import lxml.html
+except ImportError:  # lxml необязателен, без него используется BeautifulSoup
+    lxml = None
+
+# Таблица расписания в виде строк: ячейки заголовка, ячейки строк данных,
+# текст строки заголовка и текст вокруг таблицы (подпись/заголовок) в нижнем регистре
+ScheduleTable = namedtuple('ScheduleTable', ['header', 'rows', 'header_text', 'context'])
+
+HEADING_TAGS = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']
+
+# Названия месяцев: полные - для заголовка над таблицей, сокращения - для шапки
+# таблицы Рамадана ("фев./март"). Ключи MONTH_NUMBERS - первые три буквы.
+# Полное название ищется только целым словом во всех падежах: текст вокруг
+# таблицы свободный, и по одному корню совпали бы "маяк" или "майор"
+MONTH_NAME_PATTERN = re.compile(
+    r'\b((?:январ|феврал|апрел|июн|июл|сентябр|октябр|ноябр|декабр)(?:ь|я|е|ю|ем|ём)'
+    r'|(?:март|август)(?:а|е|у|ом)?'
+    r'|ма(?:й|я|е|ю|ем))\b'
+)
+MONTH_ABBR_PATTERN = re.compile(r'\b(янв|фев|мар|апр|ма[йя]|июн|июл|авг|сен|окт|ноя|дек)')
+MONTH_NUMBERS = {
+    'янв': 1, 'фев': 2, 'мар': 3, 'апр': 4, 'май': 5, 'мая': 5, 'мае': 5, 'маю': 5,
+    'июн': 6, 'июл': 7, 'авг': 8, 'сен': 9, 'окт': 10, 'ноя': 11, 'дек': 12
+}
+
+
+class BeautifulSoupBackend:
+    """Разбор HTML через BeautifulSoup (html.parser) - медленный, но без зависимостей"""
+    name = 'bs4'
+
+    def extract_table(self, content):
+        soup = BeautifulSoup(content, 'html.parser')
+        table = soup.find('table', class_='namaz_time')
+        if not table:
+            return None
+
+        trs = table.find_all('tr')
+        rows = [[td.get_text().strip() for td in tr.find_all('td')] for tr in trs]
+        header = rows[0] if rows else []
+        header_text = trs[0].get_text(separator=' ', strip=True) if trs else ''
+
+        context = [table.find('caption'), table.find_previous(HEADING_TAGS), table.find_previous_sibling()]
+        context_text = ' '.join(el.get_text(separator=' ', strip=True) for el in context if el is not None)
+        return ScheduleTable(header, rows[1:], header_text.lower(), context_text.lower())
+
+
+class LxmlBackend:
+    """Быстрый разбор HTML через lxml"""
+    name = 'lxml'
+
+    _table_xpath = "//table[contains(concat(' ', normalize-space(@class), ' '), ' namaz_time ')]"
+    _heading_xpath = 'preceding::*[' + ' or '.join(f'self::{tag}' for tag in HEADING_TAGS) + '][1]'
+
+    def extract_table(self, content):
+        if isinstance(content, bytes):
+            # Без явной кодировки lxml считает страницу latin-1, поэтому сначала пробуем UTF-8
+            try:
+                content = content.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        document = lxml.html.fromstring(content)
+        tables = document.xpath(self._table_xpath)
+        if not tables:
+            return None
+        table = tables[0]
+
+        trs = table.xpath('.//tr')
+        rows = [[td.text_content().strip() for td in tr.xpath('.//td')] for tr in trs]
+        header = rows[0] if rows else []
+        header_text = _element_text(trs[0]) if trs else ''
+
+        context = table.xpath('.//caption[1]') + table.xpath(self._heading_xpath) + table.xpath('preceding-sibling::*[1]')
+        context_text = ' '.join(_element_text(el) for el in context)
+        return ScheduleTable(header, rows[1:], header_text.lower(), context_text.lower())
+
+
+def _element_text(element):
+    """Текст элемента lxml, как get_text(separator=' ', strip=True) в BeautifulSoup"""
+    return ' '.join(text.strip() for text in element.itertext() if text.strip())
+
+
+def create_backend(name=PARSER_BACKEND):
+    """Создает бэкенд разбора HTML: 'lxml', 'bs4' или 'auto' (lxml, если установлен)"""
+    if name == 'bs4' or (name == 'auto' and lxml is None):
+        return BeautifulSoupBackend()
+    if lxml is None:
+        raise RuntimeError("Бэкенд lxml недоступен: установите пакет lxml")
+    return LxmlBackend()
+
+
+class FetchPool:
+    """Общие для парсеров всех городов HTTP-сессия, лимит запросов и предохранители.
+
+    К одному сайту одновременно выполняется не больше per_host запросов, а
+    предохранитель один на сайт: если он не отвечает, запросы всех городов с
+    этого сайта приостанавливаются вместе.
+    """
+
+    def __init__(self, per_host=FETCH_PER_HOST, timeout=10):
+        self.per_host = per_host
+        self.timeout = timeout
+        self._client = None
+        self._limits = {}
+        self.breakers = {}
+
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, follow_redirects=True)
+        return self._client
+
+    def limit(self, url):
+        """Семафор сайта, к которому относится url"""
+        host = urlsplit(url).hostname
+        if host not in self._limits:
+            self._limits[host] = asyncio.Semaphore(self.per_host)
+        return self._limits[host]
+
+    def breaker(self, url):
+        """Предохранитель сайта, к которому относится url"""
+        host = urlsplit(url).hostname
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(host)
+        return self.breakers[host]
+
+    async def close(self):
+        """Закрывает HTTP-сессию"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
 
 class NamazParser:
-    def __init__(self):
-        self.url = "https://dumso.ru/raspisanie"
+    def __init__(self, backend=None, url="https://dumso.ru/raspisanie", pool=None):
+        self.url = url
+        self.backend = backend or create_backend()
         self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+            'Accept-Encoding': 'gzip, deflate'
         }
-        self._cache = None
-        self._cache_month = None
+        self.timeout = 10
+        # Кэш расписания по месяцам: (year, month) -> {day: расписание дня (day_schedule.pack_day)}
+        self._months = {}
+        # Валидаторы для условного GET и последняя полученная страница
+        self._etag = None
+        self._last_modified = None
+        self._content = None
+        self._content_parsed = False
+        # Парсер без общего пула владеет своим пулом и закрывает его в close()
+        self._own_pool = pool is None
+        self.pool = pool or FetchPool(timeout=self.timeout)
+        # Общий предохранитель для всех запросов к сайту (планировщик, кнопки, /update_schedule)
+        self.breaker = self.pool.breaker(self.url)
     
-    def parse_schedule(self, force_refresh=False):
-        """Парсит расписание намазов на текущий месяц"""
+    def _conditional_headers(self):
+        """Заголовки запроса с If-None-Match/If-Modified-Since"""
+        headers = dict(self.headers)
+        if self._content is not None:
+            if self._etag:
+                headers['If-None-Match'] = self._etag
+            if self._last_modified:
+                headers['If-Modified-Since'] = self._last_modified
+        return headers
+    
+    def _store_response(self, status_code, headers, content):
+        """Запоминает страницу и валидаторы. Возвращает False, если страница не изменилась"""
+        if status_code == 304 and self._content is not None:
+            return False
+        self._etag = headers.get('ETag')
+        self._last_modified = headers.get('Last-Modified')
+        self._content = content
+        self._content_parsed = False
+        return True
+    
+    async def close(self):
+        """Закрывает HTTP-сессию, если пул не общий"""
+        if self._own_pool:
+            await self.pool.close()
+    
+    def _merge(self, parsed, now):
+        """Добавляет в кэш все дни со страницы и забывает месяцы старше предыдущего"""
+        for key, days in parsed.items():
+            self._months.setdefault(key, {}).update(days)
+        self._content_parsed = True
+        
+        oldest = (now.year, now.month - 1) if now.month > 1 else (now.year - 1, 12)
+        for key in [key for key in self._months if key < oldest]:
+            del self._months[key]
+    
+    def is_cached(self, date):
+        """Есть ли в кэше расписание на указанную дату"""
+        return date.day in self._months.get((date.year, date.month), {})
+    
+    def month_schedule(self, year, month):
+        """Расписание месяца из кэша: {day: расписание дня}"""
+        return self._months.get((year, month), {})
+    
+    def cached_months(self):
+        """Все закэшированные месяцы: {(year, month): {day: ...}}"""
+        return {key: dict(days) for key, days in self._months.items()}
+    
+    def get_cached_day(self, date):
+        """Расписание на дату из кэша без обращения к сайту или None"""
+        return self.month_schedule(date.year, date.month).get(date.day)
+    
+    async def parse_schedule_async(self, force_refresh=False):
+        """Асинхронно загружает и парсит расписание на текущий месяц, не блокируя event loop"""
         now = datetime.now(TIMEZONE)
-        current_month = now.month
         
-        # Используем кэш, если он актуален
-        if not force_refresh and self._cache and self._cache_month == current_month:
-            return self._cache
+        # Используем кэш, если в нем есть сегодняшний день
+        if not force_refresh and self.is_cached(now):
+            SCHEDULE_LOOKUPS.inc(source='parser_cache')
+            return self.month_schedule(now.year, now.month)
         
-        try:
-            response = requests.get(self.url, headers=self.headers, timeout=10)
-            response.raise_for_status()
-
-            soup = BeautifulSoup(response.content, 'html.parser')
-            table = soup.find('table', class_='namaz_time')
-
-            if not table:
-                raise Exception("Таблица расписания не найдена")
-
-            schedule = {}
-
-            # Проверяем, это обычное месячное расписание или специальная таблица Рамадана
-            header_row = table.find('tr')
-            header_text = header_row.get_text(separator=' ', strip=True).lower() if header_row else ""
-            is_ramadan_table = "расписание намазов на рамадан" in soup.get_text(separator=' ', strip=True).lower() or "рамадан" in header_text
-
-            rows = table.find_all('tr')[1:]  # Пропускаем заголовок
-
-            if is_ramadan_table:
-                # Структура Рамадан-таблицы:
-                # 0 - день Рамадана (1, 2, 3...)
-                # 1 - день недели
-                # 2 - дата по общему календарю (19, 20, 21...)
-                # 3..8 - времена намазов
-
-                # Попробуем определить базовый месяц из заголовка (например, "фев./март")
-                base_month = current_month
-                next_month = current_month % 12 + 1
-                if header_row:
-                    header_cols = header_row.find_all('td')
-                    if len(header_cols) >= 3:
-                        header_month_text = header_cols[2].get_text().lower()
-                        if "фев" in header_month_text and "март" in header_month_text:
-                            base_month = 2
-                            next_month = 3
-
-                month_for_row = base_month
-                prev_day_greg = None
-
-                for row in rows:
-                    cols = row.find_all('td')
-                    if len(cols) < 9:
-                        continue
-
-                    day_str = cols[2].get_text().strip()
-                    if not day_str.isdigit():
-                        continue
-
-                    day_greg = int(day_str)
-
-                    # Если дата уменьшилась по сравнению с предыдущей строкой,
-                    # считаем, что начался следующий месяц (переход с 28..29 на 1..)
-                    if prev_day_greg is not None and day_greg < prev_day_greg:
-                        month_for_row = (month_for_row % 12) + 1
-
-                    prev_day_greg = day_greg
-
-                    # Нас интересуют только строки для текущего месяца
-                    if month_for_row != current_month:
-                        continue
-
-                    schedule[day_greg] = {
-                        'fajr': self._format_time(cols[3].get_text().strip()),
-                        'sunrise': self._format_time(cols[4].get_text().strip()),
-                        'dhuhr': self._format_time(cols[5].get_text().strip()),
-                        'asr': self._format_time(cols[6].get_text().strip()),
-                        'maghrib': self._format_time(cols[7].get_text().strip()),
-                        'isha': self._format_time(cols[8].get_text().strip())
-                    }
-            else:
-                # Обычная месячная таблица (один месяц, без исламских дат)
-                # Старое поведение: берем день из первой колонки
-                for row in rows:
-                    cols = row.find_all('td')
-                    if len(cols) >= 9:
-                        day = cols[0].get_text().strip()
-                        if day.isdigit():
-                            day_num = int(day)
-                            schedule[day_num] = {
-                                'fajr': self._format_time(cols[3].get_text().strip()),
-                                'sunrise': self._format_time(cols[4].get_text().strip()),
-                                'dhuhr': self._format_time(cols[5].get_text().strip()),
-                                'asr': self._format_time(cols[6].get_text().strip()),
-                                'maghrib': self._format_time(cols[7].get_text().strip()),
-                                'isha': self._format_time(cols[8].get_text().strip())
-                            }
+        # Запросы к одному сайту ограничены пулом; предохранитель проверяется после
+        # ожидания очереди, чтобы не обращаться к сайту, который уже перестал отвечать
+        async with self.pool.limit(self.url):
+            # Сайт недавно не отвечал - до следующей попытки отдаем то, что есть в кэше
+            if not self.breaker.allow():
+                FETCH_ATTEMPTS.inc(result='breaker_open')
+                return self.month_schedule(now.year, now.month)
             
-            # Сохраняем в кэш
-            self._cache = schedule
-            self._cache_month = current_month
+            started = time.perf_counter()
+            try:
+                response = await self.pool.client().get(self.url, headers=self._conditional_headers())
+                if response.status_code != 304:
+                    response.raise_for_status()
+                changed = self._store_response(response.status_code, response.headers, response.content)
             
-            return schedule
+                # Страница не изменилась - повторно разбирать ее не нужно
+                if changed or not self._content_parsed:
+                    loop = asyncio.get_running_loop()
+                    parsed = await loop.run_in_executor(None, self._parse_content, self._content, now)
+                    self._merge(parsed, now)
+                self.breaker.record_success()
+                FETCH_ATTEMPTS.inc(result='ok' if changed else 'not_modified')
             
-        except requests.exceptions.RequestException as e:
-            print(f"❌ Ошибка подключения к сайту: {e}")
-            # Возвращаем кэш, если есть, даже если он устарел
-            return self._cache if self._cache else {}
-        except Exception as e:
-            print(f"❌ Ошибка парсинга: {e}")
-            # Возвращаем кэш, если есть, даже если он устарел
-            return self._cache if self._cache else {}
+            except httpx.HTTPError as e:
+                print(f"❌ Ошибка подключения к сайту: {e}")
+                self.breaker.record_failure(e)
+                FETCH_ATTEMPTS.inc(result='network_error')
+            except Exception as e:
+                print(f"❌ Ошибка парсинга: {e}")
+                self.breaker.record_failure(e)
+                FETCH_ATTEMPTS.inc(result='parse_error')
+            finally:
+                FETCH_DURATION.observe(time.perf_counter() - started)
+        
+        # При ошибке возвращаем то, что уже есть в кэше
+        return self.month_schedule(now.year, now.month)
     
-    def _format_time(self, time_str):
-        """Форматирует время из '6.53' в '06:53'"""
-        time_str = time_str.replace(' ', '')
-        if '.' in time_str:
-            hours, minutes = time_str.split('.')
-            return f"{int(hours):02d}:{int(minutes):02d}"
-        return time_str
+    async def prefetch_next_month_async(self):
+        """Перезапрашивает страницу, если следующего месяца еще нет в кэше. Возвращает True, если он есть"""
+        now = datetime.now(TIMEZONE)
+        next_month = (now.year, now.month + 1) if now.month < 12 else (now.year + 1, 1)
+        if next_month not in self._months:
+            await self.parse_schedule_async(force_refresh=True)
+        return next_month in self._months
     
-    def get_today_schedule(self):
-        """Возвращает расписание на сегодня"""
-        schedule = self.parse_schedule()
-        today = datetime.now(TIMEZONE).day
-        return schedule.get(today, {})
+    def _parse_content(self, content, now):
+        """Разбирает HTML-страницу с расписанием (без сетевых операций).
+        
+        Возвращает все дни со страницы: {(year, month): {day: расписание дня}}
+        """
+        table = self.backend.extract_table(content)
+
+        if not table:
+            raise Exception("Таблица расписания не найдена")
+
+        months = {}
+
+        # Проверяем, это обычное месячное расписание или специальная таблица Рамадана.
+        # Смотрим только на саму таблицу и ее заголовок, а не на текст всей страницы
+        is_ramadan_table = "расписание намазов на рамадан" in table.context or "рамадан" in table.header_text
+
+        if is_ramadan_table:
+            # Структура Рамадан-таблицы:
+            # 0 - день Рамадана (1, 2, 3...)
+            # 1 - день недели
+            # 2 - дата по общему календарю (19, 20, 21...)
+            # 3..8 - времена намазов
+
+            # Определяем базовый месяц из заголовка (например, "фев./март")
+            base_month = now.month
+            if len(table.header) >= 3:
+                header_months = _find_months(table.header[2], MONTH_ABBR_PATTERN)
+                if header_months:
+                    base_month = header_months[0]
+
+            month_for_row = base_month
+            year_for_row = _infer_year(base_month, now)
+            prev_day_greg = None
+
+            for cols in table.rows:
+                if len(cols) < 9:
+                    continue
+
+                day_str = cols[2]
+                if not day_str.isdigit():
+                    continue
+
+                day_greg = int(day_str)
+
+                # Если дата уменьшилась по сравнению с предыдущей строкой,
+                # считаем, что начался следующий месяц (переход с 28..29 на 1..)
+                if prev_day_greg is not None and day_greg < prev_day_greg:
+                    month_for_row = (month_for_row % 12) + 1
+                    if month_for_row == 1:
+                        year_for_row += 1
+
+                prev_day_greg = day_greg
+
+                # Сохраняем дни всех месяцев, которые есть в таблице
+                months.setdefault((year_for_row, month_for_row), {})[day_greg] = self._row_times(cols)
+        else:
+            # Обычная месячная таблица (один месяц, без исламских дат).
+            # Месяц берем из заголовка над таблицей, если он там однозначно указан
+            found = set(_find_months(table.context, MONTH_NAME_PATTERN))
+            month = found.pop() if len(found) == 1 else now.month
+            schedule = months.setdefault((_infer_year(month, now), month), {})
+            for cols in table.rows:
+                if len(cols) >= 9:
+                    day = cols[0]
+                    if day.isdigit():
+                        schedule[int(day)] = self._row_times(cols)
+
+        months = {key: days for key, days in months.items() if days}
+        if not months:
+            # Таблица есть, но строк с расписанием нет - скорее всего, изменилась верстка
+            raise Exception("Таблица расписания пуста")
+        return months
     
-    def get_tomorrow_schedule(self):
-        """Возвращает расписание на завтра"""
-        schedule = self.parse_schedule()
-        tomorrow_dt = datetime.now(TIMEZONE) + timedelta(days=1)
-        tomorrow = tomorrow_dt.day
-        return schedule.get(tomorrow, {})
+    def _row_times(self, cols):
+        """Времена намазов из ячеек 3..8 строки таблицы ('6.53') в минутах от полуночи"""
+        return pack_day(cols[3:9])
+
+
+def _find_months(text, pattern):
+    """Номера месяцев, упомянутых в тексте, в порядке появления"""
+    return [MONTH_NUMBERS[match.group(1)[:3]] for match in pattern.finditer(text.lower())]
+
 
+def _infer_year(month, now):
+    """Год для месяца таблицы: ближайший к текущей дате (учитывает переход через Новый год)"""
+    if month - now.month > 6:
+        return now.year - 1
+    if now.month - month > 6:
+        return now.year + 1
+    return now.year
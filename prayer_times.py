@@ -0,0 +1,223 @@
+"""Локальный расчет времени намазов по координатам города, без обращения к сайту.
+
+Используется, когда расписания нет ни в БД, ни на сайте. Год считается одним
+векторным проходом NumPy. Параметры (углы Фаджра и Иши, мазхаб Асра, поправки
+в минутах) подбираются по расписанию с сайта, сохраненному в schedule_cache.
+"""
+from datetime import date as date_type, datetime
+
+try:
+    import numpy as np
+except ImportError:  # numpy необязателен, без него локальный расчет выключен
+    np = None
+
+from config import NAMAZ_NAMES, NAMAZ_ORDER, TIMEZONE
+from day_schedule import MISSING, pack_day
+
+# Высота центра Солнца на восходе и закате (рефракция и радиус диска), градусы
+SUNRISE_ANGLE = 0.833
+# Варианты параметров, из которых калибровка выбирает лучший
+FAJR_ANGLES = [angle / 4 for angle in range(40, 81)]  # 10..20 градусов
+ISHA_ANGLES = [angle / 4 for angle in range(40, 81)]
+ASR_FACTORS = [1, 2]  # 1 - шафиитский, 2 - ханафитский
+# Меньше дней для калибровки не берем: поправки получатся случайными
+MIN_CALIBRATION_DAYS = 7
+# Дни от начала юлианского периода до 1 января 1 года (для date.toordinal())
+ORDINAL_TO_J2000 = 1721424.5 - 2451545.0
+
+
+def create_engine(latitude, longitude):
+    """Движок расчета или None, если нет координат или numpy не установлен"""
+    if np is None or latitude is None or longitude is None:
+        return None
+    return PrayerTimesEngine(latitude, longitude)
+
+
+class PrayerTimesEngine:
+    """Время намазов по положению Солнца для одной точки (часовой пояс TIMEZONE)"""
+
+    def __init__(self, latitude, longitude, fajr_angle=16.0, isha_angle=15.0, asr_factor=1):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.fajr_angle = fajr_angle
+        self.isha_angle = isha_angle
+        self.asr_factor = asr_factor
+        # Поправки к расчету в минутах, в порядке NAMAZ_ORDER
+        self.adjustments = [0] * len(NAMAZ_ORDER)
+        # Результат последней калибровки (см. calibrate)
+        self.report = None
+        # Рассчитанные годы: year -> массив (дней, намазов) минут от полуночи
+        self._years = {}
+
+    def _sun(self, dates):
+        """Полдень (часы UTC), склонение Солнца и смещение часового пояса (часы) для дат"""
+        ordinals = np.array([date.toordinal() for date in dates], dtype=float)
+        days = ordinals + ORDINAL_TO_J2000 + 0.5 - self.longitude / 360
+        anomaly = np.radians(357.529 + 0.98560028 * days)
+        mean_longitude = 280.459 + 0.98564736 * days
+        ecliptic_longitude = np.radians(
+            mean_longitude + 1.915 * np.sin(anomaly) + 0.020 * np.sin(2 * anomaly)
+        )
+        obliquity = np.radians(23.439 - 0.00000036 * days)
+        right_ascension = np.degrees(np.arctan2(
+            np.cos(obliquity) * np.sin(ecliptic_longitude), np.cos(ecliptic_longitude)
+        )) / 15
+        declination = np.arcsin(np.sin(obliquity) * np.sin(ecliptic_longitude))
+        equation_of_time = (mean_longitude / 15 - right_ascension + 12) % 24 - 12
+        noon = 12 - equation_of_time - self.longitude / 15
+        # Смещение пояса на полдень каждой даты (учитывает переход на летнее время)
+        tz_offsets = np.array([
+            TIMEZONE.utcoffset(datetime(date.year, date.month, date.day, 12)).total_seconds() / 3600
+            for date in dates
+        ])
+        return noon, declination, tz_offsets
+
+    def _hour_angle(self, declination, altitude):
+        """Часы от полудня до высоты Солнца altitude (градусы); NaN, если Солнце ее не достигает"""
+        latitude = np.radians(self.latitude)
+        cos_angle = (np.sin(np.radians(altitude)) - np.sin(declination) * np.sin(latitude)) / (
+            np.cos(declination) * np.cos(latitude)
+        )
+        with np.errstate(invalid='ignore'):
+            return np.degrees(np.arccos(cos_angle)) / 15
+
+    def _raw_times(self, sun, fajr_angle, isha_angle, asr_factor):
+        """Время намазов в минутах от местной полуночи (float, NaN - нет времени).
+
+        Параметры могут быть массивами формы (k, 1): тогда результат считается
+        сразу для k вариантов параметра.
+        """
+        noon, declination, tz_offsets = sun
+        sunrise_angle = self._hour_angle(declination, -SUNRISE_ANGLE)
+        sunrise = noon - sunrise_angle
+        maghrib = noon + sunrise_angle
+        fajr = noon - self._hour_angle(declination, -np.asarray(fajr_angle))
+        isha = noon + self._hour_angle(declination, -np.asarray(isha_angle))
+        asr_altitude = np.degrees(np.arctan(
+            1 / (np.asarray(asr_factor) + np.tan(np.abs(np.radians(self.latitude) - declination)))
+        ))
+        asr = noon + self._hour_angle(declination, asr_altitude)
+
+        # Летом на широте Саратова Солнце не опускается на 15-18 градусов: Фаджр и Иша
+        # ограничиваются долей ночи, пропорциональной углу (метод angle-based)
+        night = 24 - (maghrib - sunrise)
+        fajr_portion = np.asarray(fajr_angle) / 60 * night
+        isha_portion = np.asarray(isha_angle) / 60 * night
+        with np.errstate(invalid='ignore'):
+            fajr = np.where(np.isnan(fajr) | (sunrise - fajr > fajr_portion), sunrise - fajr_portion, fajr)
+            isha = np.where(np.isnan(isha) | (isha - maghrib > isha_portion), maghrib + isha_portion, isha)
+
+        return [(hours + tz_offsets) * 60 for hours in (fajr, sunrise, noon, asr, maghrib, isha)]
+
+    def compute(self, dates):
+        """Расписание для списка дат: массив (дат, намазов) минут от полуночи, MISSING - нет времени"""
+        raw = self._raw_times(self._sun(dates), self.fajr_angle, self.isha_angle, self.asr_factor)
+        result = np.full((len(dates), len(NAMAZ_ORDER)), MISSING, dtype=np.int16)
+        for index, (minutes, adjustment) in enumerate(zip(raw, self.adjustments)):
+            minutes = np.rint(minutes + adjustment)
+            valid = ~np.isnan(minutes)
+            result[valid, index] = np.mod(minutes[valid], 24 * 60)
+        return result
+
+    def year(self, year):
+        """Расписание на весь год (считается один раз): массив (дней года, намазов)"""
+        if year not in self._years:
+            first = date_type(year, 1, 1).toordinal()
+            last = date_type(year, 12, 31).toordinal()
+            self._years[year] = self.compute([date_type.fromordinal(day) for day in range(first, last + 1)])
+        return self._years[year]
+
+    def day(self, date):
+        """Расписание на дату в формате day_schedule"""
+        if isinstance(date, datetime):
+            date = date.date()
+        row = self.year(date.year)[date.timetuple().tm_yday - 1]
+        return pack_day(row.tolist())
+
+    def calibrate(self, samples):
+        """Подбирает параметры расчета по расписанию с сайта.
+
+        samples - [(date, расписание дня)] из schedule_cache. Возвращает отчет
+        {namaz_key: {'param', 'adjustment', 'mean', 'max'}} с отклонением в минутах
+        после калибровки или None, если дней слишком мало.
+        """
+        samples = [(date, day) for date, day in samples if any(minutes != MISSING for minutes in day)]
+        if len(samples) < MIN_CALIBRATION_DAYS:
+            return None
+
+        dates = [date for date, _ in samples]
+        observed = np.array([list(day) for _, day in samples], dtype=float)
+        observed[observed == MISSING] = np.nan
+        sun = self._sun(dates)
+
+        # Варианты параметров считаются одним проходом: формы (k, 1) -> (k, дней)
+        fajr_grid = np.array(FAJR_ANGLES)[:, None]
+        isha_grid = np.array(ISHA_ANGLES)[:, None]
+        asr_grid = np.array(ASR_FACTORS, dtype=float)[:, None]
+        fajr, sunrise, dhuhr, _, maghrib, isha = self._raw_times(sun, fajr_grid, isha_grid, 1)
+        asr = self._raw_times(sun, self.fajr_angle, self.isha_angle, asr_grid)[3]
+
+        candidates = {
+            'fajr': (fajr, FAJR_ANGLES),
+            'sunrise': (sunrise[None, :], [None]),
+            'dhuhr': (dhuhr[None, :], [None]),
+            'asr': (asr, ASR_FACTORS),
+            'maghrib': (maghrib[None, :], [None]),
+            'isha': (isha, ISHA_ANGLES),
+        }
+        report = {}
+        for index, namaz_key in enumerate(NAMAZ_ORDER):
+            computed, params = candidates[namaz_key]
+            best = _fit(computed, observed[:, index])
+            if best is None:
+                continue
+            param_index, adjustment, errors = best
+            param = params[param_index]
+            if namaz_key == 'fajr':
+                self.fajr_angle = param
+            elif namaz_key == 'isha':
+                self.isha_angle = param
+            elif namaz_key == 'asr':
+                self.asr_factor = param
+            self.adjustments[index] = adjustment
+            report[namaz_key] = {
+                'param': param,
+                'adjustment': adjustment,
+                'mean': float(np.mean(errors)),
+                'max': int(np.max(errors)),
+            }
+
+        self._years = {}
+        self.report = {'days': len(samples), 'namaz': report}
+        return self.report
+
+
+def _fit(computed, observed):
+    """Лучший вариант параметра: (индекс, поправка в минутах, отклонения по дням) или None.
+
+    computed - (вариантов, дней), observed - (дней,). Поправка - медианная
+    разница, вариант выбирается по среднему отклонению после поправки.
+    """
+    known = ~np.isnan(observed)
+    if known.sum() < MIN_CALIBRATION_DAYS:
+        return None
+    difference = observed[known] - computed[:, known]
+    valid = ~np.isnan(difference).any(axis=1)
+    if not valid.any():
+        return None
+    adjustments = np.rint(np.median(np.where(valid[:, None], difference, 0), axis=1))
+    errors = np.abs(np.rint(difference - adjustments[:, None]))
+    mean_errors = np.where(valid, errors.mean(axis=1), np.inf)
+    best = int(np.argmin(mean_errors))
+    return best, int(adjustments[best]), errors[best]
+
+
+def format_report(report):
+    """Отклонение расчета от расписания сайта для вывода администратору"""
+    if not report:
+        return "не откалиброван (мало дней с сайта)"
+    parts = [
+        f"{NAMAZ_NAMES[namaz_key]} {values['mean']:.1f}/{values['max']}"
+        for namaz_key, values in report['namaz'].items()
+    ]
+    return f"по {report['days']} дням, отклонение (среднее/макс., мин): " + ", ".join(parts)
@@ -0,0 +1,201 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from config import TIMEZONE, CITIES, DEFAULT_CITY, CALC_FALLBACK
+from parser import NamazParser, FetchPool
+from metrics import SCHEDULE_LOOKUPS
+from day_schedule import has_times
+from prayer_times import create_engine, format_report
+
+# Сколько секунд помнить, что расписания на дату нет ни в БД, ни на сайте
+MISSING_TTL = 600
+
+
+def resolve_city(city):
+    """Город пользователя или город по умолчанию, если такого города больше нет в CITIES"""
+    return city if city in CITIES else DEFAULT_CITY
+
+
+class ScheduleService:
+    """Расписание для бота и планировщика: память -> SQLite (schedule_cache) -> сайт.
+
+    У каждого города свой парсер, а HTTP-сессия, лимит запросов к сайту и
+    предохранители общие (FetchPool). Одновременные промахи по одному городу
+    объединяются в один запрос к сайту (single-flight). Если расписания нет ни
+    в БД, ни на сайте, оно рассчитывается по координатам города (prayer_times).
+    """
+
+    def __init__(self, db, parsers=None, pool=None):
+        self.db = db
+        self.pool = pool or FetchPool()
+        # Парсеры городов: city -> NamazParser
+        self.parsers = parsers or {
+            city: NamazParser(url=info['url'], pool=self.pool)
+            for city, info in CITIES.items()
+        }
+        # Дни, уже прочитанные из БД или полученные с сайта: (city, date) -> расписание дня (day_schedule)
+        self._days = {}
+        # Негативный кэш: (city, date) -> время, до которого не искать расписание повторно
+        self._missing = {}
+        # Загрузки с сайта, которые сейчас идут: city -> Future
+        self._inflight = {}
+        # Локальный расчет для городов с координатами: city -> PrayerTimesEngine
+        self.engines = {}
+        if CALC_FALLBACK:
+            for city, info in CITIES.items():
+                engine = create_engine(info.get('latitude'), info.get('longitude'))
+                if engine is not None:
+                    self.engines[city] = engine
+        # Увеличивается при каждом обновлении расписания (для сброса готовых ответов)
+        self.version = 0
+
+    async def get_day(self, date, city=DEFAULT_CITY):
+        """Возвращает расписание города на дату (day_schedule.pack_day).
+
+        Если расписания нет ни в БД, ни на сайте, возвращает рассчитанное
+        локально (см. is_computed) или None, если расчет недоступен.
+        """
+        if isinstance(date, datetime):
+            date = date.date()
+        city = resolve_city(city)
+        key = (city, date)
+
+        schedule = self._days.get(key)
+        if schedule:
+            SCHEDULE_LOOKUPS.inc(source='memory')
+            return schedule
+
+        if self._missing.get(key, 0) > time.monotonic():
+            return self._computed_day(city, date, 'missing_cached')
+
+        source = 'db'
+        schedule = await self.db.get_schedule(date.day, date.month, date.year, city)
+        if not has_times(schedule):
+            source = 'site'
+            # Без force_refresh парсер отдает кэш, если в нем есть сегодняшний день, поэтому
+            # дату, которой нет в кэше парсера (например, завтра в конце месяца), загружаем с сайта
+            await self.refresh_city(city, force_refresh=not self.parsers[city].is_cached(date))
+            schedule = self._days.get(key)
+
+        if schedule:
+            SCHEDULE_LOOKUPS.inc(source=source)
+            self._days[key] = schedule
+            self._missing.pop(key, None)
+            return schedule
+
+        self._missing[key] = time.monotonic() + MISSING_TTL
+        return self._computed_day(city, date, 'missing')
+
+    def _computed_day(self, city, date, source):
+        """Расписание, рассчитанное по координатам города, или None, если расчет недоступен.
+
+        В память не сохраняется: после MISSING_TTL снова проверяются БД и сайт.
+        """
+        engine = self.engines.get(city)
+        schedule = engine.day(date) if engine is not None else None
+        SCHEDULE_LOOKUPS.inc(source='computed' if schedule else source)
+        return schedule
+
+    def is_computed(self, date, city=DEFAULT_CITY):
+        """Расписание города на дату есть только в виде локального расчета"""
+        if isinstance(date, datetime):
+            date = date.date()
+        city = resolve_city(city)
+        return (city, date) not in self._days and city in self.engines
+
+    async def calibrate(self):
+        """Подбирает параметры локального расчета по расписанию из БД и заранее считает текущий год"""
+        year = datetime.now(TIMEZONE).year
+        for city, engine in self.engines.items():
+            samples = await self.db.get_cached_schedules(city)
+            report = engine.calibrate(samples)
+            engine.year(year)
+            if report:
+                print(f"🧮 Локальный расчет ({city}) откалиброван {format_report(report)}")
+            else:
+                print(f"⚠️ Локальный расчет ({city}) {format_report(report)}")
+
+    async def get_today(self, city=DEFAULT_CITY):
+        return await self.get_day(datetime.now(TIMEZONE), city)
+
+    async def get_tomorrow(self, city=DEFAULT_CITY):
+        return await self.get_day(datetime.now(TIMEZONE) + timedelta(days=1), city)
+
+    async def refresh(self, force_refresh=True):
+        """Загружает расписание всех городов параллельно.
+
+        Возвращает {city: расписание текущего месяца}; для города, который
+        загрузить не удалось, расписание пустое.
+        """
+        cities = list(self.parsers)
+        results = await asyncio.gather(
+            *(self.refresh_city(city, force_refresh) for city in cities),
+            return_exceptions=True
+        )
+        schedules = {}
+        for city, result in zip(cities, results):
+            if isinstance(result, Exception):
+                print(f"❌ Ошибка обновления расписания ({city}): {result}")
+                result = {}
+            schedules[city] = result
+        return schedules
+
+    async def refresh_city(self, city, force_refresh=True):
+        """Загружает расписание города с сайта и сохраняет все полученные месяцы в БД.
+
+        Возвращает расписание текущего месяца ({day: ...}) или {}, если загрузить не удалось.
+        Если загрузка уже идет, ждет ее результата вместо нового запроса.
+        """
+        city = resolve_city(city)
+        task = self._inflight.get(city)
+        if task is None:
+            task = self._inflight[city] = asyncio.ensure_future(self._refresh(city, force_refresh))
+            task.add_done_callback(lambda done: self._clear_inflight(city, done))
+        return await asyncio.shield(task)
+
+    def _clear_inflight(self, city, task):
+        if self._inflight.get(city) is task:
+            del self._inflight[city]
+
+    async def _refresh(self, city, force_refresh):
+        schedule = await self.parsers[city].parse_schedule_async(force_refresh=force_refresh)
+        if schedule:
+            await self.save_parsed_schedule(city)
+        return schedule
+
+    async def save_parsed_schedule(self, city=DEFAULT_CITY):
+        """Сохраняет в БД все месяцы города, которые есть в кэше парсера, и обновляет память"""
+        for (year, month), days in self.parsers[city].cached_months().items():
+            await self.db.save_schedule(days, month, year, city)
+            for day, times in days.items():
+                key = (city, datetime(year, month, day).date())
+                self._days[key] = times
+                self._missing.pop(key, None)
+
+        self.version += 1
+        
+        # Храним в памяти только дни начиная со вчерашнего
+        yesterday = datetime.now(TIMEZONE).date() - timedelta(days=1)
+        for key in [key for key in self._days if key[1] < yesterday]:
+            del self._days[key]
+
+    async def prefetch_next_month(self):
+        """Заранее загружает следующий месяц всех городов. Возвращает True, если он есть у всех"""
+        cities = list(self.parsers)
+        results = await asyncio.gather(
+            *(self.parsers[city].prefetch_next_month_async() for city in cities)
+        )
+        for city, ready in zip(cities, results):
+            if ready:
+                await self.save_parsed_schedule(city)
+        return all(results)
+
+    def breakers(self):
+        """Предохранители сайтов: host -> CircuitBreaker"""
+        return dict(self.pool.breakers)
+
+    async def close(self):
+        for parser in self.parsers.values():
+            await parser.close()
+        await self.pool.close()
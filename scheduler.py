@@ -1,22 +1,78 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.jobstores.base import JobLookupError
 from datetime import datetime, timedelta
 import pytz
 import logging
-from config import TIMEZONE, NOTIFICATION_OFFSET, NAMAZ_NAMES
-from parser import NamazParser
+from config import (
+    TIMEZONE, NOTIFICATION_OFFSET, NAMAZ_NAMES, NAMAZ_ORDER, NOTIFICATION_MODE, DISPATCH_MODE, DEFAULT_CITY,
+    CITIES, SCHEDULE_SNAPSHOT
+)
 from database import Database
+from schedule_service import ScheduleService, resolve_city
+from dispatcher import NotificationDispatcher, send_reminder
+from cleanup import NotificationCleaner
+from metrics import TICK_DURATION
+from day_schedule import day_epochs, format_minutes
+from snapshot import import_snapshot
 import asyncio
+import calendar
+import functools
+import os
 
 logger = logging.getLogger(__name__)
 
+# За сколько последних дней месяца начинать загружать следующий месяц
+PREFETCH_DAYS = 3
+
+# Сколько секунд после времени отправки разовая задача еще может выполниться
+# (например, если бот перезапустился ровно в эту минуту)
+FIRE_GRACE_SECONDS = 60
+
+# Сколько отправленных напоминаний копить перед записью в журнал отправки
+DELIVERY_FLUSH_SIZE = 100
+
+# Сколько секунд при остановке бота ждать завершения идущих рассылок
+SHUTDOWN_DRAIN_SECONDS = 5
+
 class NotificationScheduler:
-    def __init__(self, bot, db):
+    def __init__(self, bot, db, schedule_service=None, mode=NOTIFICATION_MODE, dispatch_mode=DISPATCH_MODE,
+                 snapshot_path=SCHEDULE_SNAPSHOT):
         self.bot = bot
         self.db = db
+        self.mode = mode
+        self.dispatch_mode = dispatch_mode
+        self.snapshot_path = snapshot_path
         self.scheduler = AsyncIOScheduler(timezone=TIMEZONE)
-        self.parser = NamazParser()
-        self.scheduled_jobs = {}
+        self.schedule_service = schedule_service or ScheduleService(db)
+        # Журнал отправленных за день напоминаний: ключи user_id * 8 + индекс намаза
+        self._delivered = set()
+        self._delivered_day = None
+        # Доставленные, но еще не записанные в журнал напоминания: (day, user_id, namaz_key)
+        self._delivery_buffer = []
+        self.dispatcher = NotificationDispatcher(bot, on_blocked=self.disable_user)
+        self._dispatch_tasks = set()
+        self.cleaner = NotificationCleaner(db, self.dispatcher)
+        # Суточный индекс времени отправки: минута (unix, UTC) -> [(индекс намаза, city, offset), ...]
+        self._timeline = {}
+        self._timeline_date = None
+        # Расписания городов на день индекса, время намазов в секундах unix
+        # (считается один раз за день) и города, расписание которых получить не удалось
+        self._timeline_schedules = {}
+        self._timeline_epochs = {}
+        self._missing_cities = set()
+        # Города, расписание которых на день индекса рассчитано локально (сайт недоступен)
+        self._computed_cities = set()
+        # Подписчики, сгруппированные по городу и времени напоминания: (city, offset) -> {user_id, ...}
+        self._offset_groups = {}
+        self._user_groups = {}
+        # Разовые задачи отправки (режим exact): минута (unix) -> id задачи
+        self._fire_jobs = {}
+        # Индекс пересобирается по одному; пока идет пересборка, refresh_user
+        # запоминает пользователей, чтобы повторить для них обновление после нее
+        self._rebuild_lock = asyncio.Lock()
+        self._pending_refresh = None
     
     async def start(self):
         """Запускает планировщик"""
@@ -27,20 +83,45 @@ class NotificationScheduler:
             id='update_schedule'
         )
         
-        # Проверка намазов каждую минуту
+        if self.mode == 'polling':
+            # Проверка намазов каждую минуту
+            self.scheduler.add_job(
+                self.check_namaz_times,
+                'interval',
+                minutes=1,
+                id='check_namaz'
+            )
+        else:
+            # Напоминания запускаются разовыми задачами из индекса. Если в 00:01
+            # расписание получить не удалось, индекс строится повторно
+            self.scheduler.add_job(
+                self.ensure_timeline,
+                'interval',
+                minutes=15,
+                id='ensure_timeline'
+            )
+        
+        if self.dispatch_mode == 'outbox':
+            # Заблокировавших бота находят процессы рассылки, а отписывает процесс бота
+            self.scheduler.add_job(
+                self.reconcile_blocked_users,
+                'interval',
+                minutes=1,
+                id='reconcile_blocked_users'
+            )
+        
+        # Предзагрузка расписания на следующий месяц в последние дни месяца
         self.scheduler.add_job(
-            self.check_namaz_times,
-            'interval',
-            minutes=1,
-            id='check_namaz'
+            self.prefetch_next_month,
+            CronTrigger(hour='*/6', minute=15),
+            id='prefetch_next_month'
         )
         
-        # Очистка старых job_id каждый час
+        # Очистка журнала отправленных напоминаний каждый день в 00:05
         self.scheduler.add_job(
-            self.clear_old_jobs,
-            'interval',
-            hours=1,
-            id='clear_old_jobs'
+            self.prune_delivery_ledger,
+            CronTrigger(hour=0, minute=5),
+            id='prune_delivery_ledger'
         )
         
         # Автоматическая очистка старых уведомлений каждый день в 03:00
@@ -50,197 +131,462 @@ class NotificationScheduler:
             id='cleanup_notifications'
         )
         
-        # Первоначальное обновление расписания
-        await self.update_schedule_daily()
+        # Прерванная при остановке бота очистка продолжается сразу после запуска
+        if await self.cleaner.has_unfinished():
+            self.scheduler.add_job(self.cleanup_old_notifications, id='cleanup_resume')
+        
+        # Снимок расписания загружается в БД до построения индекса
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            await self.load_snapshot()
+        
+        # Первоначальное обновление расписания идет в фоне: бот начинает отвечать
+        # сразу, не дожидаясь загрузки страницы с сайта
+        self.scheduler.add_job(self.initial_update, id='initial_update')
         
         self.scheduler.start()
     
+    async def load_snapshot(self):
+        """Загружает снимок расписания в БД (дни, которые уже есть в БД, не перезаписываются)"""
+        try:
+            days, written = await import_snapshot(self.db, self.snapshot_path)
+            print(f"📦 Снимок расписания {self.snapshot_path}: {days} дней, новых в БД: {written}")
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Не удалось загрузить снимок расписания {self.snapshot_path}: {e}")
+    
+    async def initial_update(self):
+        """Первый запуск: индекс по расписанию из БД, затем проверка расписания на сайте"""
+        now = datetime.now(TIMEZONE)
+        # Если сегодняшнее расписание всех городов уже есть в БД (или в снимке), напоминания
+        # работают по нему, пока загружается сайт. Иначе индекс строится после загрузки:
+        # get_day для города без расписания все равно ждал бы сайт
+        stored = await asyncio.gather(*(
+            self.db.get_schedule(now.day, now.month, now.year, city) for city in CITIES
+        ))
+        if all(stored):
+            try:
+                await self.rebuild_timeline(now)
+                print("✅ Индекс уведомлений построен по сохраненному расписанию, проверяем сайт в фоне")
+            except Exception as e:
+                print(f"❌ Ошибка построения индекса уведомлений: {e}")
+        await self.update_schedule_daily()
+    
     async def update_schedule_daily(self):
         """Обновляет расписание ежедневно. При ошибке использует данные из БД"""
         now = datetime.now(TIMEZONE)
         try:
-            # Пытаемся получить новое расписание с сайта
-            schedule = self.parser.parse_schedule(force_refresh=True)
+            # Пытаемся получить новое расписание всех городов с сайта (сохраняется в БД сервисом)
+            schedules = await self.schedule_service.refresh()
             
-            # Проверяем, что расписание не пустое
-            if not schedule or len(schedule) == 0:
-                print(f"⚠️ Получено пустое расписание. Используем данные из БД.")
-                # Пытаемся получить данные из БД для текущего дня
-                today_schedule = await self.db.get_schedule(now.day, now.month, now.year)
-                if today_schedule:
-                    print(f"✅ Используем расписание из БД для {now.day}.{now.month}.{now.year}")
-                else:
-                    print(f"❌ Нет данных в БД для {now.day}.{now.month}.{now.year}")
-                return
-            
-            # Сохраняем успешно полученное расписание
-            await self.db.save_schedule(schedule, now.month, now.year)
-            print(f"✅ Расписание успешно обновлено на {now.month}/{now.year} ({len(schedule)} дней)")
+            for city, schedule in schedules.items():
+                # Проверяем, что расписание не пустое
+                if not schedule:
+                    print(f"⚠️ Получено пустое расписание ({city}). Используем данные из БД.")
+                    # Пытаемся получить данные из БД для текущего дня
+                    today_schedule = await self.db.get_schedule(now.day, now.month, now.year, city)
+                    if today_schedule:
+                        print(f"✅ Используем расписание из БД ({city}) для {now.day}.{now.month}.{now.year}")
+                    else:
+                        print(f"❌ Нет данных в БД ({city}) для {now.day}.{now.month}.{now.year}")
+                    continue
+                
+                print(f"✅ Расписание ({city}) успешно обновлено на {now.month}/{now.year} ({len(schedule)} дней)")
             
         except Exception as e:
             print(f"❌ Ошибка обновления расписания: {e}")
             print(f"📦 Используем существующие данные из БД")
-            # Пытаемся получить данные из БД для текущего дня
+        finally:
+            # Локальный расчет подстраивается под расписание, которое есть в БД
+            try:
+                await self.schedule_service.calibrate()
+            except Exception as e:
+                print(f"⚠️ Ошибка калибровки локального расчета: {e}")
+            # После обновления расписания пересобираем индекс на сегодня
+            try:
+                await self.rebuild_timeline(now)
+            except Exception as e:
+                print(f"❌ Ошибка построения индекса уведомлений: {e}")
+    
+    async def prefetch_next_month(self):
+        """В последние дни месяца заранее загружает расписание на следующий месяц"""
+        now = datetime.now(TIMEZONE)
+        if now.day < calendar.monthrange(now.year, now.month)[1] - PREFETCH_DAYS + 1:
+            return
+        try:
+            if await self.schedule_service.prefetch_next_month():
+                print("✅ Расписание на следующий месяц загружено заранее")
+        except Exception as e:
+            print(f"⚠️ Ошибка предзагрузки расписания на следующий месяц: {e}")
+    
+    async def rebuild_timeline(self, now=None):
+        """Строит суточный индекс: минута отправки -> группы (намаз, город, время напоминания)"""
+        async with self._rebuild_lock:
+            self._pending_refresh = set()
             try:
-                today_schedule = await self.db.get_schedule(now.day, now.month, now.year)
-                if today_schedule:
-                    print(f"✅ Данные из БД доступны для {now.day}.{now.month}.{now.year}")
-                else:
-                    print(f"⚠️ Нет данных в БД. Бот будет работать с ограниченным функционалом.")
-            except Exception as db_error:
-                print(f"❌ Ошибка при обращении к БД: {db_error}")
+                await self._rebuild_timeline(now)
+            finally:
+                pending, self._pending_refresh = self._pending_refresh, None
+            # Подписки, измененные во время загрузки расписаний, могли не попасть
+            # в прочитанный список пользователей - применяем их к новому индексу
+            for user_id in sorted(pending):
+                await self.refresh_user(user_id)
+    
+    async def _rebuild_timeline(self, now=None):
+        now = now or datetime.now(TIMEZONE)
+        subscribed_users = await self.db.get_subscribed_users()
+        
+        offset_groups = {}
+        user_groups = {}
+        for user in subscribed_users:
+            group_key = (resolve_city(user.get('city')), user.get('notification_offset', NOTIFICATION_OFFSET))
+            offset_groups.setdefault(group_key, set()).add(user['user_id'])
+            user_groups[user['user_id']] = group_key
+        
+        # Расписания городов на сегодня (память -> БД -> сайт) загружаются параллельно
+        cities = sorted({city for city, offset in offset_groups} | {DEFAULT_CITY})
+        schedules = await asyncio.gather(*(self.schedule_service.get_day(now, city) for city in cities))
+        
+        self._offset_groups = offset_groups
+        self._user_groups = user_groups
+        self._timeline = {}
+        self._timeline_date = now.date()
+        self._timeline_schedules = {}
+        self._timeline_epochs = {}
+        # Города без расписания ensure_timeline пробует загрузить повторно
+        self._missing_cities = set()
+        self._computed_cities = set()
+        for city, schedule in zip(cities, schedules):
+            if schedule:
+                self._set_city_schedule(city, schedule)
+            else:
+                self._missing_cities.add(city)
+        for city, offset in self._offset_groups:
+            self._index_group(city, offset)
+        
+        if self.mode != 'polling':
+            self._unschedule_fire_jobs()
+            self._schedule_fire_jobs(self._timeline, now)
+    
+    async def ensure_timeline(self):
+        """Строит индекс на сегодня, если его еще нет, и догружает недостающие города (режим exact)"""
+        now = datetime.now(TIMEZONE)
+        try:
+            if self._timeline_date != now.date():
+                await self.rebuild_timeline(now)
+            else:
+                await self._update_incomplete_cities(now)
+        except Exception as e:
+            print(f"❌ Ошибка построения индекса уведомлений: {e}")
+    
+    async def _update_incomplete_cities(self, now):
+        """Догружает города без расписания и заменяет локальный расчет расписанием с сайта"""
+        if self._missing_cities:
+            await self._load_missing_cities(now)
+        for city in sorted(self._computed_cities):
+            # Пока сайт недоступен, get_day отдает расчет из памяти
+            await self.schedule_service.get_day(self._timeline_date, city)
+            if not self.schedule_service.is_computed(self._timeline_date, city):
+                print(f"✅ Получено расписание ({city}), индекс строится по нему вместо расчета")
+                # Уже отправленные напоминания повторно не отправятся благодаря журналу
+                await self.rebuild_timeline(now)
+                return
+    
+    async def _load_missing_cities(self, now=None):
+        """Добавляет в индекс города, расписание которых раньше получить не удалось"""
+        now = now or datetime.now(TIMEZONE)
+        for city in sorted(self._missing_cities):
+            schedule = await self.schedule_service.get_day(self._timeline_date, city)
+            if not schedule:
+                continue
+            self._missing_cities.discard(city)
+            self._set_city_schedule(city, schedule)
+            new_minutes = []
+            for group_city, offset in list(self._offset_groups):
+                if group_city == city:
+                    new_minutes.extend(self._index_group(city, offset))
+            if self.mode != 'polling':
+                self._schedule_fire_jobs(new_minutes, now)
+    
+    def _set_city_schedule(self, city, schedule):
+        """Запоминает расписание города на день индекса и время намазов в секундах unix"""
+        self._timeline_schedules[city] = schedule
+        self._timeline_epochs[city] = day_epochs(self._timeline_date, schedule)
+        if self.schedule_service.is_computed(self._timeline_date, city):
+            if city not in self._computed_cities:
+                print(f"🧮 Расписание ({city}) на {self._timeline_date} рассчитано локально")
+            self._computed_cities.add(city)
+        else:
+            self._computed_cities.discard(city)
+    
+    def _schedule_fire_jobs(self, fire_minutes, now=None):
+        """Ставит разовые задачи отправки на еще не прошедшие минуты"""
+        now = now or datetime.now(TIMEZONE)
+        earliest = now.timestamp() - FIRE_GRACE_SECONDS
+        for fire_minute in fire_minutes:
+            if fire_minute < earliest or fire_minute in self._fire_jobs:
+                continue
+            run_date = datetime.fromtimestamp(fire_minute, TIMEZONE)
+            job_id = f"reminder_{run_date:%Y%m%d%H%M}"
+            self.scheduler.add_job(
+                self.fire_reminders,
+                DateTrigger(run_date=run_date),
+                args=[fire_minute],
+                id=job_id,
+                misfire_grace_time=FIRE_GRACE_SECONDS,
+                replace_existing=True
+            )
+            self._fire_jobs[fire_minute] = job_id
+    
+    def _unschedule_fire_jobs(self):
+        for job_id in self._fire_jobs.values():
+            try:
+                self.scheduler.remove_job(job_id)
+            except JobLookupError:
+                # Задача уже выполнена
+                pass
+        self._fire_jobs = {}
+    
+    def _index_group(self, city, offset):
+        """Добавляет в индекс времена отправки всех намазов для группы (город, offset).
+        
+        Возвращает минуты отправки, которых раньше не было в индексе.
+        """
+        epochs = self._timeline_epochs.get(city)
+        new_minutes = []
+        if self._timeline_date is None or not epochs:
+            return new_minutes
+        for namaz_index, namaz_epoch in enumerate(epochs):
+            if namaz_epoch is None:
+                continue
+            fire_minute = namaz_epoch - offset * 60
+            if fire_minute not in self._timeline:
+                new_minutes.append(fire_minute)
+            self._timeline.setdefault(fire_minute, []).append((namaz_index, city, offset))
+        return new_minutes
+    
+    async def refresh_user(self, user_id):
+        """Обновляет положение пользователя в индексе после смены подписки, города или времени"""
+        if self._pending_refresh is not None:
+            self._pending_refresh.add(user_id)
+        user = await self.db.get_user(user_id)
+        
+        old_key = self._user_groups.pop(user_id, None)
+        if old_key is not None:
+            group = self._offset_groups.get(old_key)
+            if group is not None:
+                group.discard(user_id)
+        
+        if not user or not user['subscribed']:
+            return
+        
+        city = resolve_city(user.get('city'))
+        group_key = (city, user.get('notification_offset', NOTIFICATION_OFFSET))
+        self._user_groups[user_id] = group_key
+        group = self._offset_groups.get(group_key)
+        if group is None:
+            group = self._offset_groups[group_key] = set()
+            if self._timeline_date is not None and city not in self._timeline_schedules:
+                # Первый подписчик города: расписание города загружается и индексируется целиком
+                self._missing_cities.add(city)
+                await self._load_missing_cities()
+            else:
+                new_minutes = self._index_group(*group_key)
+                # Получатели берутся из групп в момент отправки, поэтому новые
+                # задачи нужны только для новой группы
+                if self.mode != 'polling':
+                    self._schedule_fire_jobs(new_minutes)
+        group.add(user_id)
     
     async def check_namaz_times(self):
         """Проверяет время намазов и отправляет уведомления"""
+        with TICK_DURATION.time():
+            await self._check_namaz_times()
+    
+    async def _check_namaz_times(self):
         try:
             now = datetime.now(TIMEZONE)
-            day = now.day
-            month = now.month
-            year = now.year
-            
-            schedule = await self.db.get_schedule(day, month, year)
-            if not schedule:
-                # Если нет в кэше, пытаемся парсить и сохранять
-                try:
-                    full_schedule = self.parser.parse_schedule(force_refresh=True)
-                    if full_schedule and len(full_schedule) > 0:
-                        await self.db.save_schedule(full_schedule, month, year)
-                        schedule = full_schedule.get(day, {})
-                        if schedule:
-                            print(f"✅ Расписание получено с сайта и сохранено в БД для {day}.{month}.{year}")
-                    else:
-                        print(f"⚠️ Сайт вернул пустое расписание. Используем данные из БД если есть.")
-                except Exception as parse_error:
-                    print(f"⚠️ Ошибка парсинга при проверке намазов: {parse_error}. Используем данные из БД.")
-                    # Если парсинг не удался, пытаемся получить данные из БД для других дней месяца
-                    # или просто продолжаем без расписания для этого дня
             
-            if not schedule:
-                return
+            # Наступил новый день - пересобираем индекс, города без расписания пробуем загрузить снова
+            if self._timeline_date != now.date():
+                await self.rebuild_timeline(now)
+            else:
+                await self._update_incomplete_cities(now)
             
-            subscribed_users = await self.db.get_subscribed_users()
-            if not subscribed_users:
+            if not self._timeline:
                 return
             
-            current_time = now.strftime('%H:%M')
+            # Уведомление должно быть отправлено в течение минуты после наступления его времени,
+            # поэтому смотрим текущую и предыдущую минуты (повторы отсекает журнал отправки)
+            minute = int(now.timestamp()) // 60 * 60
+            await self._fire((minute - 60, minute))
+        
+        except Exception as e:
+            print(f"Ошибка проверки времени намазов: {e}")
+    
+    async def fire_reminders(self, fire_minute):
+        """Разовая задача режима exact: отправляет напоминания, назначенные на fire_minute"""
+        self._fire_jobs.pop(fire_minute, None)
+        with TICK_DURATION.time():
+            try:
+                # Задача от индекса за другой день (индекс пересобран после ее запуска)
+                if fire_minute not in self._timeline:
+                    return
+                await self._fire((fire_minute,))
+            except Exception as e:
+                print(f"Ошибка отправки напоминаний: {e}")
+    
+    async def _fire(self, fire_minutes):
+        """Ставит в рассылку напоминания для указанных минут индекса"""
+        day = _ledger_day(self._timeline_date)
+        if self._delivered_day != day:
+            await self._load_delivery_ledger(day)
+        
+        jobs = []
+        labels = []
+        marked = []
+        queued = []
+        for fire_minute in fire_minutes:
+            entries = self._timeline.get(fire_minute)
+            if not entries:
+                continue
             
-            # Проверяем каждый намаз
-            for namaz_key, namaz_name in NAMAZ_NAMES.items():
-                if namaz_key not in schedule:
-                    continue
+            for namaz_index, city, offset in entries:
+                namaz_key = NAMAZ_ORDER[namaz_index]
+                # Строка времени нужна только для текста напоминания
+                namaz_time_str = format_minutes(self._timeline_schedules[city][namaz_index])
+                computed = city in self._computed_cities
+                labels.append(f"{city}/{namaz_key}/{offset}")
                 
-                namaz_time_str = schedule[namaz_key]
-                if not namaz_time_str:
-                    continue
-                
-                # Парсим время намаза
-                try:
-                    namaz_hour, namaz_minute = map(int, namaz_time_str.split(':'))
-                    # Создаем datetime для времени намаза СЕГОДНЯ в правильном часовом поясе
-                    namaz_datetime = TIMEZONE.localize(
-                        datetime(now.year, now.month, now.day, namaz_hour, namaz_minute, 0)
-                    )
+                for user_id in list(self._offset_groups.get((city, offset), ())):
+                    ledger_key = user_id * 8 + namaz_index
                     
-                    # Вычисляем время уведомления
-                    for user in subscribed_users:
-                        offset = user.get('notification_offset', NOTIFICATION_OFFSET)
-                        notification_time = namaz_datetime - timedelta(minutes=offset)
-                        
-                        # Проверяем, нужно ли отправить уведомление сейчас
-                        # Уведомление должно быть отправлено в течение текущей минуты
-                        time_diff = (notification_time - now).total_seconds()
-                        
-                        # Проверяем, что время уведомления уже наступило, но не прошло больше минуты
-                        if -60 < time_diff <= 60:
-                            job_id = f"{user['user_id']}_{namaz_key}_{day}_{month}_{year}"
-                            
-                            # Проверяем, не было ли уже отправлено уведомление
-                            if job_id not in self.scheduled_jobs:
-                                await self.send_notification(
-                                    user['user_id'],
-                                    namaz_name,
-                                    namaz_time_str,
-                                    offset
-                                )
-                                self.scheduled_jobs[job_id] = True
-                                
-                                # Удаляем из памяти через час
-                                asyncio.create_task(self.clear_job_id(job_id, 3600))
-                
-                except ValueError as e:
-                    print(f"Ошибка парсинга времени {namaz_time_str}: {e}")
-                    continue
+                    # Проверяем, не было ли уже отправлено уведомление
+                    if ledger_key not in self._delivered:
+                        # Отмечаем в памяти сразу, чтобы следующий тик не поставил отправку
+                        # повторно; в БД отправка записывается только после доставки
+                        self._delivered.add(ledger_key)
+                        marked.append(ledger_key)
+                        queued.append((user_id, namaz_key, namaz_time_str, offset, computed))
+                        jobs.append(functools.partial(
+                            self._deliver_reminder,
+                            day,
+                            user_id,
+                            namaz_key,
+                            namaz_time_str,
+                            offset,
+                            computed
+                        ))
         
-        except Exception as e:
-            print(f"Ошибка проверки времени намазов: {e}")
+        if jobs and self.dispatch_mode == 'outbox':
+            # Отправят процессы outbox_worker.py; журнал и очередь пишутся одной транзакцией
+            try:
+                await self.db.enqueue_outbox(day, queued)
+            except Exception:
+                # Очередь не записана - следующий тик должен попробовать снова
+                self._delivered.difference_update(marked)
+                raise
+            print(f"📥 В очередь: {len(queued)} напоминаний ({', '.join(labels)})")
+        elif jobs:
+            # Рассылка идет в фоне, чтобы долгая пачка не блокировала следующие тики
+            task = asyncio.create_task(self._run_fanout(jobs, ', '.join(labels)))
+            self._dispatch_tasks.add(task)
+            task.add_done_callback(self._dispatch_tasks.discard)
+    
+    async def _run_fanout(self, jobs, label):
+        """Рассылка пачки напоминаний; остаток журнала отправки записывается и при отмене"""
+        try:
+            await self.dispatcher.run_batch(jobs, label=label)
+        finally:
+            await self._flush_deliveries()
     
-    async def clear_job_id(self, job_id, delay):
-        """Удаляет job_id из памяти через указанное время"""
-        await asyncio.sleep(delay)
-        self.scheduled_jobs.pop(job_id, None)
+    async def _deliver_reminder(self, day, user_id, namaz_key, namaz_time, offset, computed=False):
+        """Отправляет напоминание и после доставки отмечает его в журнале отправки"""
+        if not await self.send_notification(user_id, NAMAZ_NAMES[namaz_key], namaz_time, offset, computed):
+            return False
+        self._delivery_buffer.append((day, user_id, namaz_key))
+        if len(self._delivery_buffer) >= DELIVERY_FLUSH_SIZE:
+            await self._flush_deliveries()
+        return True
     
-    async def clear_old_jobs(self):
-        """Очищает старые job_id (вызывается периодически)"""
-        # Очищаем job_id старше 24 часов (оставляем только сегодняшние)
-        now = datetime.now(TIMEZONE)
-        keys_to_remove = []
-        for job_id in list(self.scheduled_jobs.keys()):
-            # Формат job_id: user_id_namaz_key_day_month_year
-            parts = job_id.split('_')
-            if len(parts) >= 5:
-                try:
-                    job_day = int(parts[-3])
-                    job_month = int(parts[-2])
-                    job_year = int(parts[-1])
-                    job_date = datetime(job_year, job_month, job_day, tzinfo=TIMEZONE)
-                    if (now - job_date).days > 1:
-                        keys_to_remove.append(job_id)
-                except (ValueError, IndexError):
-                    continue
+    async def _flush_deliveries(self):
+        """Записывает накопленные доставки в журнал отправки одной транзакцией на день"""
+        buffer, self._delivery_buffer = self._delivery_buffer, []
+        by_day = {}
+        for day, user_id, namaz_key in buffer:
+            by_day.setdefault(day, []).append((user_id, namaz_key))
+        for day, entries in by_day.items():
+            try:
+                await self.db.save_deliveries(day, entries)
+            except Exception as e:
+                # Напоминания уже доставлены: запись повторится при следующем сбросе
+                print(f"⚠️ Ошибка записи журнала отправки: {e}")
+                self._delivery_buffer.extend((day, user_id, namaz_key) for user_id, namaz_key in entries)
+    
+    async def drain(self, timeout=SHUTDOWN_DRAIN_SECONDS):
+        """Дожидается идущих рассылок (не дольше timeout), остальные отменяет.
         
-        for key in keys_to_remove:
-            self.scheduled_jobs.pop(key, None)
+        Вызывается при остановке бота до закрытия БД, чтобы журнал отправки
+        содержал все доставленные напоминания.
+        """
+        tasks = list(self._dispatch_tasks)
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                print(f"⚠️ Остановка: прервано рассылок - {len(pending)}")
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await self._flush_deliveries()
+    
+    async def _load_delivery_ledger(self, day):
+        """Загружает журнал отправки за день из БД (переживает перезапуск бота)"""
+        rows = await self.db.get_deliveries(day)
+        self._delivered = {
+            user_id * 8 + NAMAZ_ORDER.index(namaz_key)
+            for user_id, namaz_key in rows
+            if namaz_key in NAMAZ_ORDER
+        }
+        self._delivered_day = day
+    
+    async def prune_delivery_ledger(self):
+        """Удаляет из журнала отправки записи старше вчерашнего дня"""
+        try:
+            yesterday = datetime.now(TIMEZONE).date() - timedelta(days=1)
+            removed = await self.db.prune_deliveries(_ledger_day(yesterday))
+            if removed:
+                print(f"Очищено {removed} старых записей журнала отправки")
+            removed = await self.db.prune_outbox(_ledger_day(yesterday))
+            if removed:
+                print(f"Очищено {removed} старых задач очереди рассылки")
+        except Exception as e:
+            print(f"❌ Ошибка очистки журнала отправки: {e}")
+    
+    async def send_notification(self, user_id, namaz_name, namaz_time, offset, computed=False):
+        """Отправляет уведомление пользователю. Возвращает True при успешной доставке.
         
-        if keys_to_remove:
-            print(f"Очищено {len(keys_to_remove)} старых job_id")
+        computed - время рассчитано по координатам города, а не взято с сайта
+        """
+        return await send_reminder(self.dispatcher, self.db, user_id, namaz_name, namaz_time, offset, computed)
+    
+    async def disable_user(self, user_id):
+        """Отписывает пользователя, заблокировавшего бота"""
+        await self.db.unsubscribe_user(user_id)
+        await self.refresh_user(user_id)
     
-    async def send_notification(self, user_id, namaz_name, namaz_time, offset):
-        """Отправляет уведомление пользователю"""
+    async def reconcile_blocked_users(self):
+        """Отписывает пользователей, о блокировке которых сообщили процессы рассылки (outbox)"""
         try:
-            message = f"🕌 Через {offset} минут намаз {namaz_name} в {namaz_time}"
-            sent_message = await self.bot.send_message(chat_id=user_id, text=message)
-            # Сохраняем message_id уведомления в БД
-            await self.db.save_message(sent_message.message_id, user_id, 'notification')
+            user_ids = await self.db.take_blocked_outbox()
+            for user_id in sorted(user_ids):
+                await self.disable_user(user_id)
+            if user_ids:
+                print(f"🚫 Отписаны заблокировавшие бота пользователи: {len(user_ids)}")
         except Exception as e:
-            print(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
+            print(f"❌ Ошибка отписки заблокировавших бота пользователей: {e}")
     
     async def cleanup_old_notifications(self):
         """Удаляет старые уведомления (старше 2 дней)"""
         try:
-            # Получаем список старых сообщений (старше 2 дней)
-            old_messages = await self.db.get_old_messages(days=2)
-            
-            if not old_messages:
-                print("Нет старых уведомлений для удаления")
-                return
-            
-            deleted_count = 0
-            failed_count = 0
-            
-            for message_id, user_id in old_messages:
-                try:
-                    await self.bot.delete_message(chat_id=user_id, message_id=message_id)
-                    deleted_count += 1
-                except Exception as e:
-                    # Сообщение уже удалено или недоступно
-                    failed_count += 1
-                    logger.debug(f"Не удалось удалить сообщение {message_id} для пользователя {user_id}: {e}")
-            
-            # Удаляем из БД все сообщения (включая те, что не удалось удалить)
-            await self.db.delete_messages(old_messages)
-            
-            print(f"✅ Автоочистка: удалено {deleted_count} уведомлений, не удалось {failed_count}")
-            
+            await self.cleaner.run(days=2)
         except Exception as e:
             print(f"❌ Ошибка автоочистки уведомлений: {e}")
     
@@ -248,3 +594,7 @@ class NotificationScheduler:
         """Останавливает планировщик"""
         self.scheduler.shutdown()
 
+
+def _ledger_day(date):
+    """Ключ дня для журнала отправки в формате YYYYMMDD"""
+    return date.year * 10000 + date.month * 100 + date.day
@@ -0,0 +1,161 @@
+"""Снимок расписания: все дни schedule_cache в одном компактном файле.
+
+Запуск:
+    python snapshot.py export schedule.snapshot [--db namaz_bot.db]
+    python snapshot.py import schedule.snapshot [--db namaz_bot.db] [--replace]
+
+Если задан SCHEDULE_SNAPSHOT, бот при запуске загружает снимок в БД (дни,
+которые уже есть в БД, не перезаписываются), сразу строит напоминания по нему
+и проверяет расписание на сайте в фоне.
+
+Формат (little-endian): b'NMZS', версия (uint16), число намазов в дне (uint8),
+число городов (uint16); для каждого города - длина ключа (uint8), ключ (UTF-8),
+число дней (uint32), даты (int32, date.toordinal()) и времена (int16, минуты от
+полуночи в порядке NAMAZ_ORDER, -1 - нет времени). Год расписания - около 6 КБ.
+"""
+import argparse
+import asyncio
+import os
+import struct
+import sys
+import time
+from array import array
+from datetime import date as date_type
+
+from config import NAMAZ_ORDER
+from database import Database
+
+MAGIC = b'NMZS'
+VERSION = 1
+HEADER = struct.Struct('<4sHBH')
+CITY_HEADER = struct.Struct('<B')
+DAYS_HEADER = struct.Struct('<I')
+
+
+def _to_bytes(values):
+    """Байты массива в little-endian"""
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, data):
+    """Массив из байтов в little-endian"""
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def dump_snapshot(schedules):
+    """Снимок из {city: [(date, расписание дня)]}"""
+    namaz_count = len(NAMAZ_ORDER)
+    parts = [HEADER.pack(MAGIC, VERSION, namaz_count, len(schedules))]
+    for city, days in schedules.items():
+        key = city.encode()
+        ordinals = array('i', (date.toordinal() for date, _ in days))
+        times = array('h')
+        for _, day in days:
+            times.extend(day)
+        parts += [
+            CITY_HEADER.pack(len(key)), key, DAYS_HEADER.pack(len(days)),
+            _to_bytes(ordinals), _to_bytes(times),
+        ]
+    return b''.join(parts)
+
+
+def load_snapshot(data):
+    """{city: [(date, расписание дня)]} из снимка. ValueError, если файл поврежден"""
+    try:
+        magic, version, namaz_count, city_count = HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError("файл слишком короткий") from None
+    if magic != MAGIC:
+        raise ValueError("это не снимок расписания")
+    if version != VERSION or namaz_count != len(NAMAZ_ORDER):
+        raise ValueError(f"неподдерживаемая версия снимка ({version}, намазов: {namaz_count})")
+
+    schedules = {}
+    offset = HEADER.size
+    try:
+        for _ in range(city_count):
+            (key_length,) = CITY_HEADER.unpack_from(data, offset)
+            offset += CITY_HEADER.size
+            city = data[offset:offset + key_length].decode()
+            offset += key_length
+            (day_count,) = DAYS_HEADER.unpack_from(data, offset)
+            offset += DAYS_HEADER.size
+            ordinals_size = day_count * 4
+            times_size = day_count * namaz_count * 2
+            if offset + ordinals_size + times_size > len(data):
+                raise ValueError("файл обрезан")
+            ordinals = _from_bytes('i', data[offset:offset + ordinals_size])
+            offset += ordinals_size
+            times = _from_bytes('h', data[offset:offset + times_size])
+            offset += times_size
+            schedules[city] = [
+                (date_type.fromordinal(ordinal), times[index * namaz_count:(index + 1) * namaz_count])
+                for index, ordinal in enumerate(ordinals)
+            ]
+    except (struct.error, UnicodeDecodeError):
+        raise ValueError("файл обрезан") from None
+    return schedules
+
+
+async def export_snapshot(db, path):
+    """Записывает все расписание из БД в снимок. Возвращает количество дней"""
+    schedules = await db.get_all_schedules()
+    data = dump_snapshot(schedules)
+    # Запись через временный файл: бот не прочитает наполовину записанный снимок
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(data)
+    os.replace(temp_path, path)
+    return sum(len(days) for days in schedules.values())
+
+
+async def import_snapshot(db, path, replace=False):
+    """Загружает снимок в БД одной транзакцией. Возвращает (дней в снимке, записано в БД)"""
+    with open(path, 'rb') as file:
+        schedules = load_snapshot(file.read())
+    written = await db.import_schedules(schedules, replace=replace)
+    return sum(len(days) for days in schedules.values()), written
+
+
+async def _run(args):
+    db = Database(args.db)
+    await db.connect()
+    try:
+        await db.init_db()
+        started = time.perf_counter()
+        if args.command == 'export':
+            days = await export_snapshot(db, args.path)
+            print(f"✅ Снимок {args.path}: {days} дней, {os.path.getsize(args.path)} байт "
+                  f"({(time.perf_counter() - started) * 1000:.1f} мс)")
+        else:
+            days, written = await import_snapshot(db, args.path, replace=args.replace)
+            print(f"✅ Загружено из {args.path}: {written} из {days} дней "
+                  f"({(time.perf_counter() - started) * 1000:.1f} мс)")
+    finally:
+        await db.close()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Снимок расписания намазов")
+    arg_parser.add_argument('command', choices=['export', 'import'])
+    arg_parser.add_argument('path')
+    arg_parser.add_argument('--db', default='namaz_bot.db')
+    arg_parser.add_argument('--replace', action='store_true',
+                            help="перезаписывать дни, которые уже есть в БД")
+    args = arg_parser.parse_args()
+    try:
+        asyncio.run(_run(args))
+    except (OSError, ValueError) as e:
+        print(f"❌ Ошибка снимка {args.path}: {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+import asyncio
+
+from database import Database, HOT_QUERIES
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    """Горячие запросы не должны сканировать таблицы (в том числе покрывающим индексом)"""
+    async def check():
+        db = Database(str(tmp_path / 'plans.db'))
+        await db.connect()
+        try:
+            await db.init_db()
+            return await db.check_query_plans()
+        finally:
+            await db.close()
+
+    assert HOT_QUERIES
+    assert asyncio.run(check()) == []
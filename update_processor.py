@@ -0,0 +1,50 @@
+import asyncio
+import sys
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+
+    Обновления одного пользователя обрабатываются строго по очереди, в порядке
+    поступления. Одновременно обрабатывается не больше max_concurrent_updates
+    обновлений; слот занимается только после того, как подошла очередь
+    пользователя, поэтому частые нажатия одного пользователя не занимают
+    все слоты и не задерживают остальных.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        # Ограничение базового класса действует до очереди пользователя, поэтому
+        # оно отключено, а лимит применяется в do_process_update
+        super().__init__(sys.maxsize)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # user_id -> [Lock, количество ожидающих обновлений]
+        self._users = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._users.get(user.id)
+        if entry is None:
+            entry = self._users[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._users[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass